@@ -18,6 +18,28 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
-from .clustering import Clustering
-from .transition_properties import TransitionProperties
-from .propagation import Propagation
+import importlib
+
+# The classes are imported on first access, so that `import cnm` stays cheap
+# for processes that only need part of the package.
+_lazy_attributes = {
+        'Clustering': 'clustering',
+        'TransitionProperties': 'transition_properties',
+        'Propagation': 'propagation',
+        'Forecaster': 'forecaster',
+        'AsyncPropagation': 'serving',
+        'PathLibrary': 'path_library',
+        }
+
+__all__ = list(_lazy_attributes)
+
+def __getattr__(name):
+    if name in _lazy_attributes:
+        module = importlib.import_module('.'+_lazy_attributes[name], __name__)
+        value = getattr(module, name)
+        globals()[name] = value
+        return value
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,29 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Entry point of `python -m cnm`, see `cnm.cli`."""
+
+import sys
+
+from .cli import main
+
+sys.exit(main())
@@ -0,0 +1,282 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Statistics used to validate the CNM model against the reference data."""
+
+import numpy as np
+
+
+def autocorrelation(x,n_blocks=1,unbiased=False,dtype=None,workers=None):
+    """Block-averaged autocorrelation function of a multi-dimensional signal.
+
+    The signal is split into `n_blocks` blocks of equal length. The mean of
+    each block is removed, the autocorrelations of all dimensions are summed
+    and the result is averaged over the blocks. All blocks and dimensions are
+    transformed in a single batched real FFT.
+
+    Parameters
+    ----------
+    x : ndarray of shape (n_times,n_dim) or (n_times,)
+        Signal, equally spaced in time.
+    n_blocks : int
+        Number of blocks. The blocks start at the same positions as with
+        `np.array_split` and are truncated to the shortest block.
+    unbiased : bool
+        If True, the lag-k sum is divided by (n-k) instead of n.
+    dtype : dtype, optional
+        Floating point type of the computation, e.g., np.float32 to halve the
+        memory. Defaults to the type of `x` (at least float32).
+    workers : int, optional
+        Number of workers of the FFT, see `scipy.fft`.
+
+    Returns
+    -------
+    r : ndarray of shape (n,)
+        Autocorrelation, where n is the length of the blocks.
+    """
+
+    x = np.asarray(x)
+    if x.ndim == 1:
+        x = x[:,None]
+
+    return ensemble_autocorrelation(
+            x[None,...],n_blocks,unbiased,dtype,workers
+            )[0]
+
+
+def ensemble_autocorrelation(x,n_blocks=1,unbiased=False,dtype=None,workers=None):
+    """Block-averaged autocorrelation of many realizations at once.
+
+    Parameters
+    ----------
+    x : ndarray of shape (n_realizations,n_times,n_dim)
+        Signals of all realizations, e.g., an ensemble of CNM propagations.
+    n_blocks, unbiased, dtype, workers :
+        See `autocorrelation`.
+
+    Returns
+    -------
+    r : ndarray of shape (n_realizations,n)
+        Autocorrelation of each realization, where n is the length of the
+        blocks.
+    """
+
+    x = np.asarray(x)
+    if x.ndim == 2:
+        x = x[...,None]
+    if dtype is None:
+        dtype = np.result_type(x.dtype,np.float32)
+
+    n_times = x.shape[1]
+    n_blocks = max(int(n_blocks),1)
+    if n_blocks > n_times:
+        raise ValueError('Cannot split {} time steps into {} blocks'.format(
+            n_times,n_blocks))
+
+    # Gather the blocks: shape (n_realizations,n_blocks,n,n_dim)
+    n, extras = divmod(n_times,n_blocks)
+    starts = np.arange(n_blocks) * n + np.minimum(np.arange(n_blocks),extras)
+    blocks = x[:,starts[:,None] + np.arange(n),:].astype(dtype)
+
+    r = _batched_autocorrelation(blocks,unbiased,workers)
+
+    return r.mean(axis=1)
+
+
+def _batched_autocorrelation(blocks,unbiased,workers):
+    """Autocorrelation along axis -2, summed over the last axis.
+
+    The blocks are zero-padded to a fast FFT length of at least 2n-1, so that
+    the circular correlation equals the linear one.
+    """
+
+    from scipy import fft
+
+    n = blocks.shape[-2]
+    blocks = blocks - blocks.mean(axis=-2,keepdims=True)
+
+    n_fft = fft.next_fast_len(2*n-1,real=True)
+    spectrum = fft.rfft(blocks,n=n_fft,axis=-2,workers=workers)
+
+    # The sum over the dimensions commutes with the inverse transform
+    power = (spectrum.real**2 + spectrum.imag**2).sum(axis=-1)
+    r = fft.irfft(power,n=n_fft,axis=-1,workers=workers)[...,:n]
+
+    if unbiased:
+        return r / (n - np.arange(n)).astype(r.dtype)
+    return r / n
+
+
+def cluster_probability(labels,K=None,coarse_map=None):
+    """Cluster probability distribution of the snapshots.
+
+    Parameters
+    ----------
+    labels : ndarray of shape (n_snapshots,)
+        Cluster affiliation of each snapshot, e.g., `Clustering.labels`.
+    K : int, optional
+        Number of clusters. Defaults to the largest label + 1.
+    coarse_map : ndarray of shape (K,), optional
+        Index of the coarse cluster of each cluster. If given, the
+        distribution of the coarse clusters is returned.
+
+    Returns
+    -------
+    q : ndarray of shape (K,) or (n_coarse,)
+        Probability of each (coarse) cluster.
+    """
+
+    labels = np.asarray(labels)
+
+    return _probability(labels,None,K,coarse_map)
+
+
+def visit_probability(visited_centroids,t,K=None,coarse_map=None):
+    """Cluster probability distribution of a CNM propagation.
+
+    The propagated state is assigned to the visited centroid that is closest
+    in time, i.e., each visit is weighted by half of the time to the previous
+    and to the next visit. This corresponds to re-clustering the interpolated
+    trajectory without interpolating it.
+
+    Parameters
+    ----------
+    visited_centroids : ndarray of shape (n_visits,)
+        Sequence of visited centroids, e.g., `Propagation.visited_centroids`.
+    t : ndarray of shape (n_visits,)
+        Time of each visit, e.g., `Propagation.t_visited`.
+    K, coarse_map :
+        See `cluster_probability`.
+
+    Returns
+    -------
+    q : ndarray of shape (K,) or (n_coarse,)
+        Probability of each (coarse) cluster.
+    """
+
+    visited_centroids = np.asarray(visited_centroids)
+    t = np.asarray(t,dtype=float)
+
+    half_steps = np.diff(t) / 2.
+    weights = np.zeros(t.size)
+    weights[:-1] += half_steps
+    weights[1:] += half_steps
+
+    return _probability(visited_centroids,weights,K,coarse_map)
+
+
+def coarse_graining_map(centroids,n_coarse,weights=None,random_state=0):
+    """Group the centroids into fewer coarse clusters.
+
+    The centroids are clustered with k-means, weighted by `weights`. Only K
+    points are clustered, so this is cheap compared to re-clustering the data.
+
+    Parameters
+    ----------
+    centroids : ndarray of shape (K,n_dim)
+        Centroids of the clusters.
+    n_coarse : int
+        Number of coarse clusters.
+    weights : ndarray of shape (K,), optional
+        Weight of each centroid, typically its cluster probability.
+    random_state : int, optional
+        Seed of the k-means initialization.
+
+    Returns
+    -------
+    coarse_map : ndarray of shape (K,)
+        Index of the coarse cluster of each cluster.
+    """
+
+    from sklearn.cluster import KMeans
+
+    kmeans = KMeans(n_clusters=n_coarse,n_init=10,random_state=random_state)
+    kmeans.fit(centroids,sample_weight=weights)
+
+    return kmeans.labels_
+
+
+def _probability(labels,weights,K,coarse_map):
+    """(Weighted) histogram of the labels, normalized to 1."""
+
+    if coarse_map is not None:
+        coarse_map = np.asarray(coarse_map)
+        labels = coarse_map[labels]
+        K = coarse_map.max() + 1
+    elif K is None:
+        K = labels.max() + 1
+
+    q = np.bincount(labels,weights=weights,minlength=K).astype(float)
+
+    return q / q.sum()
+
+
+if __name__=='__main__':
+
+    import os
+
+    test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_data')
+    data = np.load(os.path.join(test_dir,'data.npy'))[:3000]
+
+    # Direct computation of the lag sums on blocks as in np.array_split
+    def reference(x,n_blocks,unbiased):
+        blocks = np.array_split(x,n_blocks)
+        n = min(block.shape[0] for block in blocks)
+        r = np.zeros(n)
+        for block in blocks:
+            block = block[:n] - block[:n].mean(axis=0)
+            for lag in range(n):
+                lag_sum = np.sum(block[:n-lag] * block[lag:])
+                r[lag] += lag_sum / ((n - lag) if unbiased else n)
+        return r / len(blocks)
+
+    for n_blocks in [1,7]:
+        for unbiased in [False,True]:
+            r = autocorrelation(data,n_blocks,unbiased)
+            np.testing.assert_allclose(
+                    r,reference(data,n_blocks,unbiased),rtol=1e-8,atol=1e-8
+                    )
+
+    # float32 computation
+    r = autocorrelation(data,5)
+    r32 = autocorrelation(data,5,dtype=np.float32)
+    assert r32.dtype == np.float32
+    np.testing.assert_allclose(r32,r,rtol=0,atol=1e-4*abs(r).max())
+
+    # The ensemble version equals the single realizations
+    ensemble = np.stack([data,data[::-1],2*data])
+    R = ensemble_autocorrelation(ensemble,5)
+    for i_real in range(ensemble.shape[0]):
+        np.testing.assert_allclose(R[i_real],autocorrelation(ensemble[i_real],5))
+
+    # Cluster probability distributions
+    labels = np.loadtxt(os.path.join(test_dir,'labels-K5')).astype(int)
+    q = cluster_probability(labels)
+    np.testing.assert_allclose(q,np.bincount(labels)/labels.size)
+
+    # Each visit is weighted by half of the time to its neighbor visits
+    q_hat = visit_probability([0,1,0,2],[0.,1.,3.,4.])
+    np.testing.assert_allclose(q_hat,[2./4,1.5/4,0.5/4])
+
+    coarse_map = np.array([0,0,1,1,2])
+    q_coarse = cluster_probability(labels,coarse_map=coarse_map)
+    np.testing.assert_allclose(q_coarse,[q[:2].sum(),q[2:4].sum(),q[4]])
@@ -0,0 +1,351 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Run the CNM pipeline from the command line, without plotting.
+
+Example:
+
+    python -m cnm data.npy -K 50 -L 22 --dt 0.01 --t-total 950 \\
+            --realizations 100 --workers 8 --output lorenz.npz
+"""
+
+import argparse
+import os
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def main(argv=None):
+    """Cluster the data, identify the transitions, propagate and save.
+
+    Parameters
+    ----------
+    argv : list of str, optional
+        Command line arguments. Defaults to `sys.argv[1:]`.
+
+    Returns
+    -------
+    status : int
+        Exit status.
+    """
+
+    args = _parse(argv)
+
+    timings = []
+
+    @contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings.append((name,time.perf_counter()-start))
+
+    with stage('load'):
+        data = _load(args.data,args.key)
+
+    from sklearn.cluster import KMeans
+    try:
+        from .clustering import Clustering
+        from .transition_properties import TransitionProperties
+        from .propagation import Propagation
+    except ImportError:
+        from clustering import Clustering
+        from transition_properties import TransitionProperties
+        from propagation import Propagation
+
+    dataset = args.dataset
+    if dataset is None:
+        dataset = os.path.splitext(os.path.basename(args.data))[0]
+
+    with stage('clustering'):
+        cluster_algo = KMeans(
+                n_clusters=args.K,max_iter=300,n_init=args.n_init,random_state=args.seed
+                )
+        # The seeded restarts do not depend on the number of processes, so
+        # that --workers does not change the clustering
+        n_jobs = 1 if args.workers is None else args.workers
+        clustering = Clustering(data,cluster_algo,dataset,n_jobs=n_jobs)
+
+    with stage('transitions'):
+        transition_properties = TransitionProperties(
+                clustering,args.K,args.L,args.dt,min_count=args.min_count,
+                cache=not args.no_cache,
+                )
+
+    path_library = None
+    if args.interpolation == 'paths':
+        try:
+            from .path_library import PathLibrary
+        except ImportError:
+            from path_library import PathLibrary
+        with stage('paths'):
+            path_library = PathLibrary(clustering,data)
+
+    with stage('propagation'):
+        propagation = Propagation(
+                transition_properties,sample_times=args.sample_times,
+                interpolation=args.interpolation,path_library=path_library,
+                )
+        ics = np.broadcast_to(np.asarray(args.ic,dtype=int),(args.realizations,))
+        trajectories = propagation.run_ensemble(
+                args.t_total,ics,args.dt_out,random_state=args.seed,n_jobs=args.workers,
+                )
+
+    with stage('output'):
+        output = args.output
+        if output is None:
+            output = os.path.join(clustering.data_folder,'propagation')
+        output = _save(output,args.format,clustering,trajectories,args.t_total,args.dt_out)
+
+    print('Saved in {}'.format(output))
+    print('Stage timings')
+    print('-------------')
+    for name, elapsed in timings:
+        print('{:<12s}{:10.3f} s'.format(name,elapsed))
+    print('{:<12s}{:10.3f} s'.format('total',sum(elapsed for _, elapsed in timings)))
+
+    return 0
+
+
+def _parse(argv):
+    """Command line arguments."""
+
+    parser = argparse.ArgumentParser(
+            prog='python -m cnm',
+            description='Cluster-based network modeling of a time series: '
+                        'clustering, transition properties and propagation.',
+            )
+    parser.add_argument('data',
+            help='Snapshots of shape (n_snapshots,n_dim), equally spaced in '
+                 'time, in a .npy (memory-mapped) or .npz file')
+    parser.add_argument('--key',
+            help='Array of a .npz file. Defaults to its only array')
+    parser.add_argument('-K',type=int,required=True,help='Number of clusters')
+    parser.add_argument('-L',type=int,default=1,help='Model order (default: 1)')
+    parser.add_argument('--dt',type=float,required=True,help='Time step of the data')
+    parser.add_argument('--t-total',type=float,required=True,
+            help='Simulation time of each realization')
+    parser.add_argument('--realizations',type=int,default=1,
+            help='Number of propagated realizations (default: 1)')
+    parser.add_argument('--ic',type=int,default=0,
+            help='Initial centroid of the realizations (default: 0)')
+    parser.add_argument('--dt-out',type=float,
+            help='Time step of the reconstructed trajectories. By default, '
+                 'the visited clusters are saved')
+    parser.add_argument('--interpolation',default='spline',
+            choices=['spline','linear','hermite','paths'],
+            help='Reconstruction of the trajectories (default: spline)')
+    parser.add_argument('--sample-times',action='store_true',
+            help='Draw the transition times from their distribution')
+    parser.add_argument('--min-count',type=int,default=1,
+            help='Minimum number of occurrences of a past (default: 1)')
+    parser.add_argument('--n-init',type=int,default=10,
+            help='Number of k-means restarts (default: 10)')
+    parser.add_argument('--workers',type=int,
+            help='Number of processes of the clustering restarts and of '
+                 'threads of the propagation. -1 uses all the cores. The '
+                 'clustering does not depend on it, the random streams of '
+                 'the realizations do (default: 1)')
+    parser.add_argument('--seed',type=int,default=0,help='Random seed (default: 0)')
+    parser.add_argument('--dataset',
+            help='Name of the cache folder output/<dataset>. Defaults to the '
+                 'name of the data file')
+    parser.add_argument('--no-cache',action='store_true',
+            help='Do not cache the transition properties')
+    parser.add_argument('--output',
+            help='Output file (npz) or folder (npy). Defaults to '
+                 'output/<dataset>/propagation')
+    parser.add_argument('--format',default='npz',choices=['npz','npy'],
+            help='npz: one compressed file. npy: one file per array, which '
+                 'can be memory-mapped (default: npz)')
+
+    args = parser.parse_args(argv)
+
+    if args.realizations < 1:
+        parser.error('--realizations must be >= 1')
+
+    return args
+
+
+def _load(path,key=None):
+    """Read the snapshots, memory-mapped if possible.
+
+    The arrays of a .npz file are read in memory, as they are zipped.
+    """
+
+    if path.endswith('.npz'):
+        with np.load(path) as archive:
+            if key is None:
+                if len(archive.files) != 1:
+                    raise Exception('Select the data among {} with --key'.format(archive.files))
+                key = archive.files[0]
+            data = archive[key]
+    else:
+        data = np.load(path,mmap_mode='r')
+
+    if data.ndim == 1:
+        data = data[:,None]
+    if data.ndim != 2:
+        raise Exception('The data must be of shape (n_snapshots,n_dim), not {}'.format(data.shape))
+
+    return data
+
+
+def _save(output,output_format,clustering,trajectories,t_total,dt_out):
+    """Save the centroids and the propagated trajectories.
+
+    Without `dt_out`, the visits of all the realizations are concatenated:
+    those of realization i are t[indptr[i]:indptr[i+1]] and
+    labels[indptr[i]:indptr[i+1]]. Otherwise, the reconstructed trajectories
+    are truncated to the common times t < t_total and stacked in x, of shape
+    (n_realizations,n_times,n_dim).
+
+    Returns
+    -------
+    output : str
+        The written file or folder.
+    """
+
+    arrays = {'centroids': clustering.centroids}
+
+    if dt_out is None:
+        lengths = [t_hat.size for t_hat, _ in trajectories]
+        arrays['indptr'] = np.concatenate(([0],np.cumsum(lengths)))
+        arrays['t'] = np.concatenate([t_hat for t_hat, _ in trajectories])
+        arrays['labels'] = np.concatenate([labels_hat for _, labels_hat in trajectories])
+    else:
+        n_times = min(
+                [np.count_nonzero(t_hat < t_total) for t_hat, _ in trajectories]
+                )
+        arrays['t'] = trajectories[0][0][:n_times]
+        arrays['x'] = np.stack([x_hat[:n_times] for _, x_hat in trajectories])
+
+    if output_format == 'npz':
+        if not output.endswith('.npz'):
+            output += '.npz'
+        folder = os.path.dirname(output)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        np.savez_compressed(output,**arrays)
+    else:
+        if not os.path.exists(output):
+            os.makedirs(output)
+        for name, array in arrays.items():
+            np.save(os.path.join(output,name+'.npy'),array)
+
+    return output
+
+
+if __name__=='__main__':
+
+    import shutil
+    import tempfile
+
+    # CNM config
+    data_path = os.path.abspath('test_data/data.npy')
+    data = np.load(data_path)
+    K, L, dt, t_total, n_real = 5, 2, 0.016666944449074152, 20., 3
+    config = [data_path,'-K',str(K),'-L',str(L),'--dt',str(dt),
+              '--t-total',str(t_total),'--realizations',str(n_real),
+              '--ic','1','--n-init','4','--seed','3','--dataset','cli']
+
+    cwd = os.getcwd()
+    folder = tempfile.mkdtemp()
+    try:
+        # the caches of output/cli are written in the temporary folder
+        os.chdir(folder)
+
+        results = {}
+        for output_format in ['npz','npy']:
+            for dt_out in [None,0.05]:
+                output = os.path.join(folder,'{}-{}'.format(output_format,dt_out))
+                argv = config + ['--format',output_format,'--output',output]
+                if dt_out is not None:
+                    argv += ['--dt-out',str(dt_out)]
+                assert main(argv) == 0
+
+                if output_format == 'npz':
+                    assert not os.path.exists(output)
+                    with np.load(output+'.npz') as archive:
+                        arrays = dict(archive)
+                else:
+                    arrays = {
+                        name[:-4]: np.load(os.path.join(output,name),mmap_mode='r')
+                        for name in os.listdir(output)
+                        }
+                results[output_format,dt_out] = arrays
+
+                centroids = arrays['centroids']
+                assert centroids.shape == (K,data.shape[1])
+                if dt_out is None:
+                    assert sorted(arrays) == ['centroids','indptr','labels','t']
+                    indptr, t, labels = arrays['indptr'], arrays['t'], arrays['labels']
+                    assert indptr.shape == (n_real+1,) and indptr[0] == 0
+                    assert indptr[-1] == t.size == labels.size
+                    for i_real in range(n_real):
+                        t_real = t[indptr[i_real]:indptr[i_real+1]]
+                        labels_real = labels[indptr[i_real]:indptr[i_real+1]]
+                        assert t_real[0] == 0 and labels_real[0] == 1
+                        assert np.all(np.diff(t_real) > 0) and t_real[-1] >= t_total
+                        assert np.all((labels_real >= 0) & (labels_real < K))
+                        assert np.all(labels_real[1:] != labels_real[:-1])
+                else:
+                    assert sorted(arrays) == ['centroids','t','x']
+                    t, x = arrays['t'], arrays['x']
+                    assert np.all(t < t_total) and t[-1] >= t_total - 2*dt_out
+                    np.testing.assert_allclose(np.diff(t),dt_out)
+                    assert x.shape == (n_real,t.size,data.shape[1])
+                    np.testing.assert_allclose(x[:,0],np.tile(centroids[1],(n_real,1)))
+                    assert np.all(np.isfinite(x))
+
+        # both formats save the same arrays, and the cached model gives the
+        # same realizations
+        for dt_out in [None,0.05]:
+            npz, npy = results['npz',dt_out], results['npy',dt_out]
+            for name in npz:
+                np.testing.assert_array_equal(npz[name],npy[name])
+        np.testing.assert_array_equal(
+                results['npz',None]['centroids'],results['npz',0.05]['centroids']
+                )
+
+        # the number of workers does not change the fitted clustering, and
+        # the default is one worker
+        centroids = []
+        for i_workers, workers in enumerate([None,1,2]):
+            output = os.path.join(folder,'workers-{}'.format(i_workers))
+            argv = config[:-1] + ['workers-{}'.format(i_workers),'--output',output]
+            if workers is not None:
+                argv += ['--workers',str(workers)]
+            assert main(argv) == 0
+            with np.load(output+'.npz') as archive:
+                centroids.append(archive['centroids'])
+                if workers is None:
+                    labels = archive['labels']
+                elif workers == 1:
+                    np.testing.assert_array_equal(archive['labels'],labels)
+        for centroids_workers in centroids[1:]:
+            np.testing.assert_array_equal(centroids_workers,centroids[0])
+
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(folder)
@@ -22,6 +22,7 @@
 
 import numpy as np
 import os
+import pickle
 
 class Clustering:
     """Perform the data clustering with the requested clustering algorithm.
@@ -29,14 +30,25 @@ class Clustering:
     Attributes
     ----------
     labels : ndarray of shape (n_snapshots,)
-        Cluster affiliation of each snapshot.
+        Cluster affiliation of each snapshot. When the clustering is read from
+        the disk, the labels are only loaded at first access.
     centroids : ndarray of shape (K,n_dim)
-        Centroids of the clusters.
+        Centroids of the clusters. With a reduction, they are lifted back to
+        the full space at first access.
     cluster_sequence : ndarray of shape (# transition+1,)
         Sequence of visited clusters.
+    run_lengths : ndarray of shape (# transition+1,)
+        Number of consecutive snapshots of each visit of `cluster_sequence`.
+    reduction : object or None
+        The fitted dimensionality reduction, if any.
+    reduced_centroids : ndarray of shape (K,n_components) or None
+        Centroids of the clusters in the reduced space, if any.
+    data_folder : str
+        Folder of the cached clustering, 'output/<dataset>'.
     """
 
-    def __init__(self,data,cluster_algo,dataset):
+    def __init__(self,data,cluster_algo,dataset,dtype=None,n_jobs=None,
+                 reduction=None,chunk_size=None):
         """
         Parameters
         ----------
@@ -49,6 +61,30 @@ class Clustering:
             A label defining the dataset (e.g., 'lorenz', 'boundary_layer',
             ...). Defines the folder where the clustering output will be
             stored.
+        dtype : dtype, optional
+            Floating point type of the centroids, e.g., np.float32 to halve
+            the memory of the centroids and of the propagated trajectories.
+            Defaults to the type returned by the clustering algorithm.
+        n_jobs : int, optional
+            Number of processes among which the restarts (`n_init`) of the
+            clustering algorithm are distributed. Each restart has its own
+            seed, derived from the seed of `cluster_algo` (0 if not set). The
+            data is shared between the processes and the restart with the
+            lowest inertia is kept. The result does not depend on `n_jobs`,
+            and n_jobs=1 runs the same restarts in this process. -1 uses all
+            the cores. By default, the clustering algorithm runs its restarts
+            itself, with different seeds.
+        reduction : object, optional
+            Instance of a dimensionality reduction (e.g., sklearn's PCA,
+            IncrementalPCA or SparseRandomProjection). Must provide 'fit()' or
+            'partial_fit()', 'transform()' and 'inverse_transform()'. The
+            snapshots are clustered in the reduced space, which makes the
+            distance computations cheaper for high-dimensional snapshots.
+        chunk_size : int, optional
+            Number of snapshots per block when fitting the reduction (if it
+            provides 'partial_fit()') and when transforming the data, so that
+            the data (e.g., memory-mapped) is streamed. By default, the whole
+            data is processed at once.
         """
 
         # Perform clustering
@@ -61,39 +97,386 @@ class Clustering:
 
         # Ouput path (create folder if necessary)
         data_folder = 'output/{}'.format(dataset)
-        data_path = os.path.join(
-                data_folder,'clustering-K{}'.format(cluster_algo.n_clusters)
-                )
+        data_name = 'clustering-K{}'.format(cluster_algo.n_clusters)
+        if reduction is not None:
+            data_name += '-' + _reduction_key(reduction)
+        data_path = os.path.join(data_folder,data_name)
         if not os.path.exists(data_folder):
             os.makedirs(data_folder)
 
+        self.data_folder = data_folder
+        self._data_path = data_path
+        self._dtype = dtype
+        self._centroids = None
+        self._labels = None
+        self._data_file = None
+        self._index = None
+        self.reduction = None
+        self.reduced_centroids = None
+
         if not os.path.exists(data_path+'.npz'):
             print('Compute and save in {}'.format(data_path+'.npz'))
 
-            cluster_algo.fit(data)
+            # Cluster in the reduced space
+            if reduction is not None:
+                print('Reduce the data dimension')
+                self.reduction = reduction
+                data = self._reduce(data,chunk_size)
 
-            self.labels = cluster_algo.labels_
-            self.centroids = cluster_algo.cluster_centers_
-            diff = np.diff(self.labels)
-            self.cluster_sequence = self.labels[np.insert(diff.astype(np.bool), 0, True)]
+            if n_jobs is None:
+                cluster_algo.fit(data)
+            else:
+                cluster_algo = _fit_restarts(data,cluster_algo,n_jobs)
 
-            np.savez(
-                    data_path,
-                    labels = cluster_algo.labels_,
-                    centroids = cluster_algo.cluster_centers_,
-                    cluster_sequence = self.cluster_sequence
-                    )
+            self._labels = cluster_algo.labels_
+            self._compute_visits()
+
+            output = {
+                    'labels': cluster_algo.labels_,
+                    'cluster_sequence': self.cluster_sequence,
+                    'run_lengths': self.run_lengths,
+                    }
+            if reduction is None:
+                self._centroids = cluster_algo.cluster_centers_
+                output['centroids'] = cluster_algo.cluster_centers_
+            else:
+                self.reduced_centroids = cluster_algo.cluster_centers_
+                output['reduced_centroids'] = cluster_algo.cluster_centers_
+                with open(data_path+'-reduction.pkl','wb') as f:
+                    pickle.dump(self.reduction,f)
+            np.savez(data_path,**output)
 
         else:
             print('Read from {}'.format(data_path+'.npz'))
             data = np.load(
                     data_path+'.npz',
                     )
-            self.labels = data['labels']
-            self.centroids = data['centroids']
-            self.cluster_sequence = data['cluster_sequence']
+            self._data_file = data
+            if 'run_lengths' in data:
+                self.cluster_sequence = data['cluster_sequence']
+                self.run_lengths = data['run_lengths']
+            else:
+                # Output of a previous version
+                self._compute_visits()
+            if 'reduced_centroids' in data:
+                self.reduced_centroids = data['reduced_centroids']
+                with open(data_path+'-reduction.pkl','rb') as f:
+                    self.reduction = pickle.load(f)
+            else:
+                self._centroids = data['centroids']
+
+        if dtype is not None and self._centroids is not None:
+            self._centroids = self._centroids.astype(dtype)
         print('\n')
 
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = self._data_file['labels']
+        return self._labels
+
+    @property
+    def centroids(self):
+        if self._centroids is None:
+
+            # Lift the centroids from the reduced space
+            centroids = self.reduction.inverse_transform(self.reduced_centroids)
+            if self._dtype is not None:
+                centroids = centroids.astype(self._dtype)
+            self._centroids = centroids
+
+        return self._centroids
+
+    def _compute_visits(self):
+        """Compute the sequence of visited clusters and their lengths."""
+
+        self.cluster_sequence, self.run_lengths = run_length_encode(self.labels)
+
+    def assign(self,data,chunk_size=10000,n_jobs=None,algorithm='auto'):
+        """Assign snapshots to the nearest centroid.
+
+        The data is processed in chunks of `chunk_size` snapshots, so that the
+        extra memory is bounded and memory-mapped data is streamed. The index
+        of the centroids is built at the first call.
+
+        Parameters
+        ----------
+        data : ndarray of shape (n_snapshots,n_dim)
+            Snapshots to label.
+        chunk_size : int, optional
+            Number of snapshots per chunk.
+        n_jobs : int, optional
+            Number of threads labelling the chunks. -1 uses all the cores.
+        algorithm : {'auto', 'kd_tree', 'gemm'}, optional
+            'kd_tree' queries a KD tree of the centroids, which is efficient in
+            low dimension. 'gemm' computes the distances with a matrix product,
+            ||x||^2 - 2 x.c + ||c||^2, which is efficient in high dimension.
+            'auto' selects 'kd_tree' up to 10 dimensions.
+
+        Returns
+        -------
+        labels : ndarray of shape (n_snapshots,)
+            Index of the nearest centroid of each snapshot.
+        """
+
+        index = self._get_index(algorithm)
+
+        n_snapshots = data.shape[0]
+        labels = np.empty(n_snapshots,dtype=np.intp)
+
+        def assign_chunk(start):
+            chunk = data[start:start+chunk_size]
+            if self.reduction is not None:
+                chunk = self.reduction.transform(chunk)
+            labels[start:start+chunk_size] = index(chunk)
+
+        if n_jobs is not None and n_jobs < 0:
+            n_jobs = os.cpu_count()
+        if n_jobs is None or n_jobs == 1:
+            for start in range(0,n_snapshots,chunk_size):
+                assign_chunk(start)
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(n_jobs) as pool:
+                list(pool.map(assign_chunk,range(0,n_snapshots,chunk_size)))
+
+        return labels
+
+    def _get_index(self,algorithm):
+        """Build (once) the nearest-centroid search function.
+
+        The centroids are searched in the space where the clustering was
+        performed.
+        """
+
+        centroids = self.reduced_centroids
+        if centroids is None:
+            centroids = self.centroids
+
+        if algorithm == 'auto':
+            algorithm = 'kd_tree' if centroids.shape[1] <= 10 else 'gemm'
+
+        if self._index is None or self._index[0] != algorithm:
+
+            if algorithm == 'kd_tree':
+                from sklearn.neighbors import KDTree
+                tree = KDTree(centroids)
+
+                def index(chunk):
+                    return tree.query(chunk,k=1,return_distance=False)[:,0]
+
+            elif algorithm == 'gemm':
+
+                # ||x||^2 is the same for all the centroids and is not needed
+                centroids_t = np.ascontiguousarray(centroids.T)
+                half_norms = 0.5 * np.einsum('ij,ij->i',centroids,centroids)
+
+                def index(chunk):
+                    return np.argmin(half_norms - chunk @ centroids_t,axis=1)
+
+            else:
+                raise ValueError('Unknown algorithm {}'.format(algorithm))
+
+            self._index = (algorithm,index)
+
+        return self._index[1]
+
+    def _reduce(self,data,chunk_size):
+        """Fit the reduction and project the data, chunk by chunk.
+
+        Returns
+        -------
+        reduced_data : ndarray of shape (n_snapshots,n_components)
+            The data in the reduced space.
+        """
+
+        n_snapshots = data.shape[0]
+        if chunk_size is None:
+            chunk_size = n_snapshots
+        chunks = [
+                slice(start,min(start+chunk_size,n_snapshots))
+                for start in range(0,n_snapshots,chunk_size)
+                ]
+
+        # Fit the reduction
+        if hasattr(self.reduction,'partial_fit') and len(chunks) > 1:
+            for chunk in chunks:
+                self.reduction.partial_fit(data[chunk])
+        else:
+            self.reduction.fit(data)
+
+        # Project the data
+        reduced_data = None
+        for chunk in chunks:
+            reduced_chunk = self.reduction.transform(data[chunk])
+            if reduced_data is None:
+                reduced_data = np.empty(
+                        (n_snapshots,reduced_chunk.shape[1]),dtype=reduced_chunk.dtype
+                        )
+            reduced_data[chunk] = reduced_chunk
+
+        return reduced_data
+
+def run_length_encode(labels,chunk_size=1000000):
+    """Sequence of visited clusters and number of snapshots of each visit.
+
+    The labels are read in chunks of `chunk_size`, so that the extra memory
+    is O(chunk_size) besides the output, e.g., for memory-mapped labels. A
+    visit may continue across chunks.
+
+    Parameters
+    ----------
+    labels : array_like of shape (n_snapshots,)
+        Cluster affiliation of each snapshot.
+    chunk_size : int, optional
+        Number of labels read at once.
+
+    Returns
+    -------
+    cluster_sequence : ndarray of shape (n_visits,)
+        Sequence of visited clusters.
+    run_lengths : ndarray of shape (n_visits,)
+        Number of snapshots of each visit.
+    """
+
+    cluster_sequence, run_lengths = [], []
+
+    # The last visit of a chunk may continue in the next chunk
+    last_cl, last_length = None, None
+    for start in range(0,len(labels),chunk_size):
+        chunk = np.asarray(labels[start:start+chunk_size])
+        new_visit = np.ones(chunk.size,dtype=bool)
+        np.not_equal(chunk[1:],chunk[:-1],out=new_visit[1:])
+        starts = np.flatnonzero(new_visit)
+        visited_cl = chunk[starts]
+        lengths = np.diff(np.append(starts,chunk.size))
+
+        if last_cl is not None:
+            if visited_cl[0] == last_cl[0]:
+                lengths[0] += last_length[0]
+            else:
+                cluster_sequence.append(last_cl)
+                run_lengths.append(last_length)
+        cluster_sequence.append(visited_cl[:-1])
+        run_lengths.append(lengths[:-1])
+        last_cl, last_length = visited_cl[-1:], lengths[-1:]
+
+    if last_cl is None:
+        labels = np.asarray(labels)
+        return labels[:0], np.zeros(0,dtype=np.intp)
+    cluster_sequence.append(last_cl)
+    run_lengths.append(last_length)
+
+    return np.concatenate(cluster_sequence), np.concatenate(run_lengths)
+
+def _reduction_key(reduction):
+    """Name of the reduction and hash of its parameters, for the cache."""
+
+    import hashlib
+
+    params = reduction.get_params() if hasattr(reduction,'get_params') else vars(reduction)
+    digest = hashlib.sha1(repr(sorted(params.items())).encode()).hexdigest()[:8]
+
+    return '{}-{}'.format(type(reduction).__name__,digest)
+
+def _fit_restarts(data,cluster_algo,n_jobs):
+    """Run the restarts of `cluster_algo`, in a process pool if n_jobs > 1.
+
+    Each restart fits a copy of `cluster_algo` with n_init=1 and its own seed.
+    The seeds are derived from the seed of `cluster_algo`, so that the result
+    is reproducible and independent of n_jobs.
+
+    Returns
+    -------
+    cluster_algo : object
+        The fitted copy with the lowest inertia.
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import shared_memory
+    from sklearn.base import clone
+
+    # Number of restarts
+    n_init = cluster_algo.n_init
+    if n_init == 'auto':
+        n_init = 1 if isinstance(cluster_algo.init,str) and cluster_algo.init == 'k-means++' else 10
+    if n_jobs < 0:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs,n_init)
+
+    # One seed per restart
+    random_state = cluster_algo.random_state
+    if random_state is None:
+        random_state = 0
+    elif isinstance(random_state,np.random.RandomState):
+        random_state = random_state.randint(np.iinfo(np.int32).max)
+    seeds = np.random.SeedSequence(random_state).generate_state(n_init)
+
+    estimators = [
+            clone(cluster_algo).set_params(n_init=1,random_state=int(seed))
+            for seed in seeds
+            ]
+
+    if n_jobs == 1:
+        for estimator in estimators:
+            estimator.fit(data)
+        return _best_restart(estimators,data)
+
+    # Share the data among the processes
+    data = np.ascontiguousarray(data)
+    shared = shared_memory.SharedMemory(create=True,size=max(data.nbytes,1))
+    try:
+        np.ndarray(data.shape,data.dtype,buffer=shared.buf)[...] = data
+
+        with ProcessPoolExecutor(
+                n_jobs,
+                initializer=_attach_shared_data,
+                initargs=(shared.name,data.shape,data.dtype),
+                ) as pool:
+            estimators = list(pool.map(_fit_restart,estimators))
+
+        return _best_restart(estimators,data)
+    finally:
+        shared.close()
+        shared.unlink()
+
+def _best_restart(estimators,data):
+    """The restart with the lowest inertia (the first one in case of a tie),
+    with the labels of the data."""
+
+    best = estimators[int(np.argmin([elt.inertia_ for elt in estimators]))]
+    best.labels_ = best.predict(data)
+
+    return best
+
+# Data shared with the restart processes
+_shared_memory = None
+_shared_data = None
+_thread_limits = None
+
+def _attach_shared_data(name,shape,dtype):
+    """Attach the shared data in a restart process."""
+
+    from multiprocessing import shared_memory
+    from threadpoolctl import threadpool_limits
+    global _shared_data, _shared_memory, _thread_limits
+
+    # One thread per process, the parallelism is over the restarts
+    _thread_limits = threadpool_limits(1)
+
+    _shared_memory = shared_memory.SharedMemory(name=name)
+    _shared_data = np.ndarray(shape,dtype,buffer=_shared_memory.buf)
+
+def _fit_restart(cluster_algo):
+    """Fit a single restart on the shared data."""
+
+    cluster_algo.fit(_shared_data)
+
+    # The labels are recomputed for the best restart only
+    del cluster_algo.labels_
+
+    return cluster_algo
+
 if __name__=='__main__':
 
     from sklearn.cluster import KMeans
@@ -120,3 +503,73 @@ if __name__=='__main__':
 
     # check labels
     assert np.all(clustering.labels == labels_test)
+
+    # check visits
+    assert np.all(np.repeat(clustering.cluster_sequence,clustering.run_lengths) == labels_test)
+
+    # chunked visits, including visits across chunks and memory-mapped labels
+    import tempfile
+    for chunk_size in [1,7,1000,10**6]:
+        cluster_sequence, run_lengths = run_length_encode(clustering.labels,chunk_size)
+        assert np.all(cluster_sequence == clustering.cluster_sequence)
+        assert np.all(run_lengths == clustering.run_lengths)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        np.save(os.path.join(tmp_dir,'labels.npy'),clustering.labels)
+        labels = np.load(os.path.join(tmp_dir,'labels.npy'),mmap_mode='r')
+        cluster_sequence, run_lengths = run_length_encode(labels,chunk_size=500)
+        assert np.all(run_lengths == clustering.run_lengths)
+        del labels
+    assert run_length_encode(np.array([],dtype=int))[0].size == 0
+
+    # parallel restarts are reproducible and independent of the number of
+    # processes
+    kmeans = KMeans(n_clusters=k,max_iter=1000,n_init=8)
+    best_1 = _fit_restarts(data,kmeans,1)
+    best_2 = _fit_restarts(data,kmeans,2)
+    best_4 = _fit_restarts(data,kmeans,4)
+    for best in [best_1,best_4]:
+        assert np.all(best_2.cluster_centers_ == best.cluster_centers_)
+        assert np.all(best_2.labels_ == best.labels_)
+
+    # the best restart is kept
+    seeds = np.random.SeedSequence(0).generate_state(8)
+    inertias = [
+            KMeans(n_clusters=k,max_iter=1000,n_init=1,random_state=int(seed)).fit(data).inertia_
+            for seed in seeds
+            ]
+    np.testing.assert_allclose(best_2.inertia_,min(inertias))
+
+    # assign the data to the centroids, with both nearest-centroid searches
+    for algorithm in ['kd_tree','gemm']:
+        labels = clustering.assign(data,chunk_size=999,n_jobs=2,algorithm=algorithm)
+        assert np.all(labels == clustering.labels)
+
+    # clustering in a reduced space, with the PCA streamed in chunks
+    from sklearn.decomposition import IncrementalPCA
+    cluster_config = {
+            'data': data,
+            'cluster_algo': KMeans(n_clusters=k,max_iter=1000,n_init=10),
+            'dataset': 'dummy',
+            'reduction': IncrementalPCA(n_components=2),
+            'chunk_size': 5000,
+            }
+    from sklearn.decomposition import PCA
+    clustering = Clustering(**cluster_config)
+    other_config = dict(cluster_config,reduction=PCA(n_components=2))
+    other = Clustering(**other_config)
+    try:
+        assert clustering.reduced_centroids.shape == (k,2)
+        assert clustering.centroids.shape == (k,data.shape[1])
+        np.testing.assert_allclose(
+                clustering.centroids,
+                clustering.reduction.inverse_transform(clustering.reduced_centroids)
+                )
+        assert np.all(clustering.assign(data) == clustering.labels)
+
+        # another reduction with as many components has its own cache
+        assert other._data_path != clustering._data_path
+        assert isinstance(other.reduction,PCA)
+    finally:
+        for elt in [clustering,other]:
+            os.remove(elt._data_path+'.npz')
+            os.remove(elt._data_path+'-reduction.pkl')
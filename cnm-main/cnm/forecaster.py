@@ -0,0 +1,232 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+from collections import deque
+
+class Forecaster:
+    """Online forecast of the next cluster and of its arrival time.
+
+    The snapshots are ingested as they arrive. Each snapshot is assigned to
+    its nearest centroid, and the last L visited clusters and the time spent
+    in the current cluster are updated in constant time.
+
+    Attributes
+    ----------
+    transition : instance
+        Instance from the TransitionProperties class.
+    clustering : instance
+        Instance from the Clustering class.
+    L : int
+        CNM model order
+    dt : float
+        Time step of the snapshots.
+    n_steps : int
+        Number of snapshots since the current cluster was entered.
+    """
+
+    def __init__(self,transition_properties,dt=None):
+        """
+        Parameters
+        ----------
+        transition_properties : instance
+            Instance from the TransitionProperties class.
+        dt : float, optional
+            Time step of the snapshots. Defaults to the time step of the data
+            of the model.
+        """
+
+        self.transition = transition_properties
+        self.clustering = transition_properties.clustering
+        self.L = transition_properties.L
+        self.dt = transition_properties.dt if dt is None else dt
+
+        self.reset()
+
+    @property
+    def past_cl(self):
+        """The last L visited clusters (oldest first)."""
+        return list(self._past_cl)
+
+    @property
+    def ready(self):
+        """True once L clusters have been visited."""
+        return len(self._past_cl) == self.L
+
+    def reset(self):
+        """Forget the visited clusters."""
+
+        self._past_cl = deque(maxlen=self.L)
+        self.n_steps = 0
+
+    def update(self,snapshot):
+        """Ingest one snapshot.
+
+        Parameters
+        ----------
+        snapshot : ndarray of shape (n_dim,)
+            The new snapshot.
+
+        Returns
+        -------
+        label : int
+            Cluster of the snapshot.
+        """
+
+        label = int(self.clustering.assign(np.asarray(snapshot)[None,:])[0])
+        self._add_visit(label,1)
+
+        return label
+
+    def update_batch(self,snapshots,chunk_size=10000,n_jobs=None):
+        """Ingest consecutive snapshots at once.
+
+        The snapshots are assigned in one vectorized call. The result is the
+        same as calling `update()` for each snapshot.
+
+        Parameters
+        ----------
+        snapshots : ndarray of shape (n_snapshots,n_dim)
+            The new snapshots, in time order.
+        chunk_size, n_jobs :
+            See `Clustering.assign()`.
+
+        Returns
+        -------
+        labels : ndarray of shape (n_snapshots,)
+            Cluster of each snapshot.
+        """
+
+        labels = self.clustering.assign(snapshots,chunk_size,n_jobs)
+        if labels.size == 0:
+            return labels
+
+        # Visits of the snapshots
+        starts = np.concatenate(([0],np.flatnonzero(np.diff(labels)) + 1))
+        n_steps = np.diff(np.append(starts,labels.size))
+
+        # The first visit may continue the current one
+        self._add_visit(int(labels[0]),int(n_steps[0]))
+
+        # The next visits are new ones, of which only the last L remain in the
+        # history. They are not merged with the current visit, even if an
+        # older visit had the same cluster.
+        for start, n in zip(starts[1:][-self.L:],n_steps[1:][-self.L:]):
+            self._past_cl.append(int(labels[start]))
+            self.n_steps = int(n)
+
+        return labels
+
+    def forecast(self):
+        """Forecast the next cluster and its arrival time.
+
+        All the possible next clusters are returned at once. The arrival time
+        is the transition time of the model minus the time already spent in the
+        current cluster, which assumes that the current and next clusters are
+        crossed in similar times.
+
+        Returns
+        -------
+        destinations : ndarray of shape (n,)
+            Index of the possible next clusters.
+        probabilities : ndarray of shape (n,)
+            Probability of each destination.
+        arrival_times : ndarray of shape (n,)
+            Expected time until each destination is reached.
+        """
+
+        if not self.ready:
+            raise Exception('Less than L={} clusters have been visited'.format(self.L))
+
+        past_cl, destinations, probabilities, transition_times = \
+                self.transition.transitions(self.past_cl)
+        elapsed = self.n_steps * self.dt
+        arrival_times = np.maximum(transition_times - elapsed,0)
+
+        return destinations, probabilities, arrival_times
+
+    def _add_visit(self,label,n_steps):
+        """Add n_steps snapshots in cluster `label`."""
+
+        if self._past_cl and self._past_cl[-1] == label:
+            self.n_steps += n_steps
+        else:
+            self._past_cl.append(label)
+            self.n_steps = n_steps
+
+if __name__=='__main__':
+
+    from sklearn.cluster import KMeans
+    from clustering import Clustering
+    from transition_properties import TransitionProperties
+
+    # CNM config
+    K = 5
+    L = 3
+    dt = 0.016666944449074152
+
+    # Model of the test data
+    data = np.load('test_data/data.npy')
+    cluster_config = {
+            'data': data,
+            'cluster_algo': KMeans(n_clusters=K,max_iter=1000,n_init=100),
+            'dataset': 'dummy'
+            }
+    clustering = Clustering(**cluster_config)
+    transition_properties = TransitionProperties(clustering,K,L,dt)
+
+    # Replay the data snapshot by snapshot
+    forecaster = Forecaster(transition_properties)
+    n_snapshots = 3000
+    forecast = None
+    for i_snapshot in range(n_snapshots):
+        label = forecaster.update(data[i_snapshot])
+        assert label == clustering.labels[i_snapshot]
+
+        # The observed transitions have been forecast
+        if forecast is not None and forecaster.n_steps == 1:
+            destinations, probabilities, arrival_times = forecast
+            assert label in destinations
+            assert np.isclose(probabilities.sum(),1)
+            assert np.all(arrival_times >= 0)
+
+        forecast = forecaster.forecast() if forecaster.ready else None
+
+    # Ingesting by batches gives the same state, also when more than L visits
+    # are skipped within a batch
+    batch_forecaster = Forecaster(transition_properties)
+    for start in range(0,n_snapshots,700):
+        batch_forecaster.update_batch(data[start:min(start+700,n_snapshots)])
+    assert batch_forecaster.past_cl == forecaster.past_cl
+    assert batch_forecaster.n_steps == forecaster.n_steps
+
+    first_order = TransitionProperties(clustering,K,1,dt)
+    for batch_size in [1,7,50,700]:
+        forecaster = Forecaster(first_order)
+        batch_forecaster = Forecaster(first_order)
+        for start in range(0,n_snapshots,batch_size):
+            batch = data[start:min(start+batch_size,n_snapshots)]
+            for snapshot in batch:
+                forecaster.update(snapshot)
+            batch_forecaster.update_batch(batch)
+            assert batch_forecaster.past_cl == forecaster.past_cl
+            assert batch_forecaster.n_steps == forecaster.n_steps
@@ -0,0 +1,260 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import numpy as np
+
+class PathLibrary:
+    """Average path of the data between two consecutive centroids.
+
+    For each transition i->j observed in the data, the snapshots between the
+    middle of the visit of cluster i and the middle of the visit of cluster j
+    are resampled to `n_points` points equally spaced in time, and averaged
+    over all the occurrences of the transition. The average path is then
+    corrected linearly, so that it starts at centroid i and ends at centroid
+    j.
+
+    A propagated trajectory is reconstructed by stretching the path of each
+    transition over its transition time (see `interpolate()`), which costs a
+    gather and a linear interpolation per output sample, and follows the
+    shape of the data instead of a spline through the centroids.
+
+    Attributes
+    ----------
+    centroids : ndarray of shape (K,n_dim)
+        Centroids of the clusters.
+    n_points : int
+        Number of points of each path.
+    pairs : ndarray of shape (n_pairs,2)
+        Origin and destination cluster of each observed transition, sorted.
+    counts : ndarray of shape (n_pairs,)
+        Number of occurrences of each transition in the data.
+    paths : ndarray of shape (n_pairs,n_points,n_dim)
+        Average path of each transition, from the origin to the destination
+        centroid.
+    nbytes : int
+        Memory footprint of the paths, in bytes.
+    """
+
+    def __init__(self,clustering,data,n_points=16,chunk_size=1000):
+        """
+        Parameters
+        ----------
+        clustering : instance
+            Instance from the Clustering class.
+        data : ndarray of shape (n_snapshots,n_dim)
+            The snapshots of the clustering, e.g., memory-mapped.
+        n_points : int, optional
+            Number of points of each path, including both centroids.
+        chunk_size : int, optional
+            Number of transitions resampled at once, which bounds the extra
+            memory to chunk_size*n_points*n_dim values.
+        """
+
+        print('Build the path library')
+        print('----------------------')
+        print('Points per path: {}'.format(n_points))
+
+        if data.shape[0] != clustering.labels.size:
+            raise Exception('The data must be the {} snapshots of the clustering'.format(
+                clustering.labels.size))
+        if n_points < 2:
+            raise Exception('A path has at least 2 points')
+
+        self.centroids = clustering.centroids
+        self.n_points = n_points
+        K = self.centroids.shape[0]
+
+        # Middle of each visit, as a fractional snapshot index
+        run_lengths = clustering.run_lengths
+        starts = np.cumsum(run_lengths) - run_lengths
+        middles = starts + (run_lengths - 1) / 2.
+
+        # The transition to the final cluster is neglected, as in
+        # TransitionProperties, because the final visit is not complete
+        cluster_sequence = clustering.cluster_sequence.astype(np.int64)
+        n_transitions = max(cluster_sequence.size - 2,0)
+        codes = cluster_sequence[:n_transitions] * K + cluster_sequence[1:n_transitions+1]
+        codes, inverse, self.counts = np.unique(
+                codes,return_inverse=True,return_counts=True
+                )
+        self.pairs = np.column_stack(np.divmod(codes,K))
+
+        # Sum of the resampled segments of each transition
+        s = np.linspace(0.,1.,n_points)
+        sums = np.zeros((codes.size,n_points,data.shape[1]))
+        for start in range(0,n_transitions,chunk_size):
+            stop = min(start+chunk_size,n_transitions)
+            positions = middles[start:stop,None] \
+                    + s * (middles[start+1:stop+1] - middles[start:stop])[:,None]
+            i_snapshot = np.minimum(positions.astype(int),data.shape[0]-2)
+            weights = (positions - i_snapshot)[...,None]
+            segments = (1 - weights) * data[i_snapshot] + weights * data[i_snapshot+1]
+            np.add.at(sums,inverse[start:stop],segments)
+        paths = sums / np.maximum(self.counts,1)[:,None,None]
+
+        # Start and end at the centroids
+        paths += (1 - s)[:,None] * (self.centroids[self.pairs[:,0]] - paths[:,0])[:,None,:]
+        paths += s[:,None] * (self.centroids[self.pairs[:,1]] - paths[:,-1])[:,None,:]
+        self.paths = paths.astype(self.centroids.dtype)
+
+        print('Number of paths: {}'.format(codes.size))
+        print('Memory footprint: {:.3g} MB'.format(self.nbytes / 1e6))
+        print('\n')
+
+    @property
+    def nbytes(self):
+        return self.paths.nbytes
+
+    def find(self,origins,destinations):
+        """Index of the paths of transitions.
+
+        Parameters
+        ----------
+        origins, destinations : ndarray of shape (n,)
+            Origin and destination cluster of each transition.
+
+        Returns
+        -------
+        i_paths : ndarray of shape (n,)
+            Row of each transition in `pairs`, or -1 if it is not in the
+            library.
+        """
+
+        K = self.centroids.shape[0]
+        codes = self.pairs[:,0] * K + self.pairs[:,1]
+        query = np.asarray(origins,dtype=np.int64) * K + np.asarray(destinations)
+
+        i_paths = np.minimum(np.searchsorted(codes,query),max(codes.size-1,0))
+        found = codes.size > 0 and codes[i_paths] == query
+
+        return np.where(found,i_paths,-1)
+
+    def interpolate(self,t,visited_centroids,dt):
+        """Reconstruct a centroid-to-centroid trajectory with the paths.
+
+        The path of each transition is stretched over its transition time.
+        Transitions not in the library (e.g., from the neighbor past of
+        `TransitionProperties.step()`) are interpolated linearly between the
+        centroids.
+
+        Parameters
+        ----------
+        t : ndarray of shape (n_visits,)
+            Time of the sequential cluster visits.
+        visited_centroids : ndarray of shape (n_visits,)
+            Sequence of visited clusters.
+        dt : float
+            Time step of the reconstructed trajectory.
+
+        Returns
+        -------
+        t_int : ndarray of shape (n_times,)
+            Times of the trajectory, with the same limits as `t`.
+        x_int : ndarray of shape (n_times,n_dim)
+            The trajectory.
+        """
+
+        visited_centroids = np.asarray(visited_centroids)
+        t_int = np.arange(t[0],t[-1],dt)
+
+        # Segment and relative position of each time
+        i_seg = np.clip(np.searchsorted(t,t_int,side='right') - 1,0,t.size-2)
+        s = (t_int - t[i_seg]) / (t[i_seg+1] - t[i_seg])
+        i_paths = self.find(visited_centroids[:-1],visited_centroids[1:])[i_seg]
+
+        # Time warp of the paths
+        position = s * (self.n_points - 1)
+        i_point = np.minimum(position.astype(int),self.n_points-2)
+        weights = (position - i_point)[:,None]
+        x_int = (1 - weights) * self.paths[i_paths,i_point] \
+                + weights * self.paths[i_paths,i_point+1]
+
+        missing = i_paths < 0
+        if np.any(missing):
+            origins = self.centroids[visited_centroids[i_seg[missing]]]
+            destinations = self.centroids[visited_centroids[i_seg[missing]+1]]
+            x_int[missing] = origins + s[missing,None] * (destinations - origins)
+
+        return t_int, x_int.astype(self.paths.dtype)
+
+if __name__=='__main__':
+
+    from sklearn.cluster import KMeans
+    from clustering import Clustering
+    from transition_properties import TransitionProperties
+
+    # CNM config
+    K = 5
+    dt = 0.016666944449074152
+
+    # Model of the test data
+    data = np.load('test_data/data.npy')
+    cluster_config = {
+            'data': data,
+            'cluster_algo': KMeans(n_clusters=K,max_iter=1000,n_init=100),
+            'dataset': 'dummy'
+            }
+    clustering = Clustering(**cluster_config)
+    library = PathLibrary(clustering,data,n_points=16,chunk_size=100)
+
+    # one path per transition of the first-order model
+    transition_properties = TransitionProperties(clustering,K,1,dt)
+    transitions = np.column_stack((
+        np.repeat(transition_properties.histories[:,0],np.diff(transition_properties.indptr)),
+        transition_properties.destinations,
+        ))
+    assert sorted(map(tuple,transitions.tolist())) == list(map(tuple,library.pairs.tolist()))
+    assert library.counts.sum() == clustering.cluster_sequence.size - 2
+
+    # the paths join the centroids
+    np.testing.assert_allclose(library.paths[:,0],clustering.centroids[library.pairs[:,0]])
+    np.testing.assert_allclose(library.paths[:,-1],clustering.centroids[library.pairs[:,1]])
+
+    # average path of one transition, resampled snapshot by snapshot
+    i_pair = 0
+    middles = np.cumsum(clustering.run_lengths) - (clustering.run_lengths + 1) / 2.
+    s = np.linspace(0.,1.,16)
+    reference = np.zeros((16,data.shape[1]))
+    for i_visit in range(clustering.cluster_sequence.size-2):
+        if tuple(clustering.cluster_sequence[i_visit:i_visit+2]) == tuple(library.pairs[i_pair]):
+            positions = middles[i_visit] + s * (middles[i_visit+1] - middles[i_visit])
+            for i_dim in range(data.shape[1]):
+                reference[:,i_dim] += np.interp(positions,np.arange(data.shape[0]),data[:,i_dim])
+    reference /= library.counts[i_pair]
+    reference += (1 - s)[:,None] * (clustering.centroids[library.pairs[i_pair,0]] - reference[0])
+    reference += s[:,None] * (clustering.centroids[library.pairs[i_pair,1]] - reference[-1])
+    np.testing.assert_allclose(library.paths[i_pair],reference,atol=1e-10)
+
+    # the paths are stretched over the transition times, and the unknown
+    # transitions are linear
+    origin, destination = library.pairs[i_pair]
+    unknown = [(i,j) for i in range(K) for j in range(K) if i != j
+               and (i,j) not in set(map(tuple,library.pairs.tolist()))]
+    visited = [origin,destination] + list(unknown[0])
+    t_int, x_int = library.interpolate(np.array([0.,1.,2.,3.]),visited,1./30)
+    i_paths = library.find(visited[:-1],visited[1:])
+    assert i_paths[0] == i_pair and i_paths[2] == -1
+    np.testing.assert_allclose(x_int[[0,30,60]],clustering.centroids[visited[:3]],atol=1e-12)
+    np.testing.assert_allclose(x_int[:30:2],library.paths[i_pair,:15],atol=1e-12)
+    np.testing.assert_allclose(
+            x_int[75],clustering.centroids[visited[2:]].mean(axis=0),atol=1e-12
+            )
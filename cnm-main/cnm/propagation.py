@@ -21,7 +21,7 @@
 #
 
 import numpy as np
-from tqdm import tqdm
+import os
 
 class Propagation:
     """Perform the CNM propagation
@@ -36,22 +36,71 @@ class Propagation:
         Sequence of visited clusters.
     L : int
         CNM model order
+    sample_times : bool
+        If True, the transition times are drawn from their distribution in the
+        data instead of using their average.
+    interpolation : str
+        Reconstruction of the state between the visited centroids: 'spline'
+        (global spline), 'linear' or 'hermite' (blending per segment), or
+        'paths' (average data paths, see `path_library`).
+    path_library : instance or None
+        Instance from the PathLibrary class, used by the 'paths'
+        interpolation.
+    visited_centroids : ndarray of shape (n_visits,)
+        Sequence of centroids visited by the last propagation. If several
+        threads propagate at once, use the returned arrays instead.
+    t_visited : ndarray of shape (n_visits,)
+        Time of each visit of the last propagation.
+
+    Notes
+    -----
+    The state of a propagation (the past and the random numbers) is local to
+    each call, and the model is read-only, so that one instance can be used by
+    several threads. Each thread should pass its own `random_state`.
     """
 
-    def __init__(self,transition_properties):
+    def __init__(self,transition_properties,sample_times=False,
+                 interpolation='spline',path_library=None):
         """
         Parameters
         ----------
         transition_transition : instance
             Instance from the TransitionProperties class.
+        sample_times : bool, optional
+            If True, the transition times are drawn from their distribution,
+            see `TransitionProperties.sample_transition_times()`.
+        interpolation : str, optional
+            'spline' fits a spline through all the visited centroids. 'linear'
+            and 'hermite' blend the centroids of each segment in closed form,
+            linearly or with a cubic Hermite polynomial (with finite
+            difference slopes, see np.gradient). They do not overshoot over long transitions
+            as much as the spline, and their cost is linear in the number of
+            output samples. 'paths' stretches the average data path of each
+            transition over its transition time, see `PathLibrary`.
+        path_library : instance, optional
+            Instance from the PathLibrary class, built from the data of the
+            model. Required by the 'paths' interpolation.
         """
 
+        if interpolation not in ('spline','linear','hermite','paths'):
+            raise Exception('Unknown interpolation: {}'.format(interpolation))
+        if interpolation == 'paths' and path_library is None:
+            raise Exception('The paths interpolation requires a path_library')
+
         self.transition = transition_properties
-        self.centroids = transition_properties.clustering.centroids
         self.cluster_sequence = transition_properties.cluster_sequence
         self.L = transition_properties.L
+        self.sample_times = sample_times
+        self.interpolation = interpolation
+        self.path_library = path_library
+
+    @property
+    def centroids(self):
+        # Only read when the state is reconstructed, as the centroids of a
+        # reduced clustering are lifted to the full space at first access
+        return self.transition.centroids
 
-    def run(self,t_total,ic,dt):
+    def run(self,t_total,ic,dt,random_state=None):
         """Propagate the state in the phase space.
 
         Parameters
@@ -61,50 +110,298 @@ class Propagation:
         ic: int
             Initial condition, index of the centroid used as initial condition.
         dt: float
-            Time step for the spline-interpolated trajectory.
+            Time step for the interpolated trajectory.
+        random_state : int or np.random.Generator, optional
+            Seed or generator of the random numbers. Defaults to the global
+            NumPy state.
 
         Returns
         -------
+        t_hat: ndarray of shape (n_times,)
+            Times of the interpolated trajectory.
         x_hat: ndarray of shape (n_times x n_dim)
-            The predicted state interpolated with splines. n_times is the number
-            of steps after spline interpolation.
+            The predicted state, interpolated as set by `interpolation`. n_times
+            is the number of steps after interpolation.
+        """
+
+        t, visited_centroids = self._propagate(t_total,ic,random_state)
+
+        # Smooth the trajectory
+        return self._interpolate(t,visited_centroids,dt)
+
+    def run_clusters(self,t_total,ic,dt=None,random_state=None):
+        """Propagate the sequence of visited clusters only.
+
+        The state is not reconstructed, so that no (n_times,n_dim) array is
+        created. This is sufficient for label-level analyses, e.g., the
+        cluster probability distribution.
+
+        Parameters
+        ----------
+        t_total : float
+            Total simulation time. Propagation stops when this time is reached.
+        ic: int
+            Initial condition, index of the centroid used as initial condition.
+        dt: float, optional
+            If given, the labels are sampled with this time step, instead of
+            returning one entry per visited cluster.
+        random_state : int or np.random.Generator, optional
+            See `run()`.
+
+        Returns
+        -------
+        t_hat: ndarray of shape (n_visits,) or (n_times,)
+            Time of each cluster visit, or uniformly sampled times if `dt` is
+            given.
+        labels_hat: ndarray of shape (n_visits,) or (n_times,)
+            Sequence of visited clusters, or the cluster closest in time to
+            each sample if `dt` is given.
+        """
+
+        t, visited_centroids = self._propagate(t_total,ic,random_state)
+
+        if dt is None:
+            return t, visited_centroids
+
+        # Each sample belongs to the visit that is closest in time
+        t_int = np.arange(t[0],t[-1],dt)
+        t_middle = (t[1:] + t[:-1]) / 2.
+        labels_int = visited_centroids[np.searchsorted(t_middle,t_int)]
+
+        return t_int, labels_int
+
+    def run_ensemble(self,t_total,ics,dt=None,random_state=None,n_jobs=None):
+        """Propagate many independent trajectories at once.
+
+        All the trajectories are stepped together with
+        `TransitionProperties.step_batch()`, so that the cost of a step is
+        shared by the ensemble. With `n_jobs`, the trajectories are split
+        between threads, which share the model. The batched steps are NumPy
+        operations on whole arrays, which release the GIL.
+
+        Parameters
+        ----------
+        t_total : float or ndarray of shape (n_realizations,)
+            Total simulation time of each trajectory.
+        ics: ndarray of shape (n_realizations,)
+            Index of the initial centroid of each trajectory.
+        dt: float, optional
+            If given, the trajectories are interpolated with this time step, as
+            in `run()`. Otherwise, the visited clusters are returned,
+            as in `run_clusters()`.
+        random_state : int or np.random.Generator, optional
+            Seed or generator of the random numbers. Defaults to the global
+            NumPy state. With several threads, each thread has a generator
+            seeded from it, so that the result depends on `n_jobs`.
+        n_jobs : int, optional
+            Number of threads. -1 uses all the cores.
+
+        Returns
+        -------
+        trajectories: list of tuples
+            For each trajectory, (t_hat, x_hat) if `dt` is given, else
+            (t_hat, labels_hat) with one entry per visited cluster.
+        """
+
+        ics = np.asarray(ics,dtype=int).reshape(-1)
+        t_total = np.broadcast_to(np.asarray(t_total,dtype=float),ics.shape)
+
+        if n_jobs is not None and n_jobs < 0:
+            n_jobs = os.cpu_count()
+        if n_jobs is None or n_jobs == 1:
+            return self._run_ensemble(t_total,ics,dt,_check_random_state(random_state))
+
+        from concurrent.futures import ThreadPoolExecutor
+        chunks = np.array_split(np.arange(ics.size),n_jobs)
+        with ThreadPoolExecutor(n_jobs) as pool:
+            results = pool.map(
+                    lambda chunk, random_state: self._run_ensemble(
+                        t_total[chunk],ics[chunk],dt,random_state
+                        ),
+                    chunks,_spawn(random_state,n_jobs),
+                    )
+
+            return [trajectory for result in results for trajectory in result]
+
+    def _run_ensemble(self,t_total,ics,dt,random_state):
+        """Propagate the trajectories of `run_ensemble()` in one batch."""
+
+        n_realizations = ics.size
+        i_histories = np.array(
+                [self.transition.initial_history(ic) for ic in ics],dtype=int
+                )
+
+        # Growing storage of the visits
+        capacity = 64
+        t = np.zeros((n_realizations,capacity))
+        visited_centroids = np.empty((n_realizations,capacity),dtype=int)
+        visited_centroids[:,0] = ics
+        n_visits = np.ones(n_realizations,dtype=int)
+
+        # Propagate the unfinished trajectories together
+        active = np.flatnonzero(t_total > 0)
+        while active.size > 0:
+
+            if n_visits[active].max() == capacity:
+                t = np.pad(t,((0,0),(0,capacity)))
+                visited_centroids = np.pad(visited_centroids,((0,0),(0,capacity)))
+                capacity *= 2
+
+            i_histories[active], next_cl, transition_time = \
+                    self.transition.step_batch(
+                            i_histories[active],random_state,self.sample_times
+                            )
+
+            i_visit = n_visits[active]
+            t[active,i_visit] = t[active,i_visit-1] + transition_time
+            visited_centroids[active,i_visit] = next_cl
+            n_visits[active] += 1
+
+            active = active[t[active,i_visit] < t_total[active]]
+
+        trajectories = []
+        for i_real in range(n_realizations):
+            t_real = t[i_real,:n_visits[i_real]]
+            visited_real = visited_centroids[i_real,:n_visits[i_real]]
+            if dt is None:
+                trajectories.append((t_real,visited_real))
+            else:
+                trajectories.append(self._interpolate(t_real,visited_real,dt))
+
+        return trajectories
+
+    def run_until_converged(self,ic,tol=1e-3,t_check=None,t_max=None,
+                            keep_trajectory=False,random_state=None):
+        """Propagate until the cluster probability distribution converges.
+
+        The time spent in each cluster is accumulated during the propagation,
+        each visit being weighted by half of the time to the previous and to
+        the next visit, as in `analysis.visit_probability()`. Every `t_check`,
+        the distribution is compared with the one of the previous check, and
+        the propagation stops when their total variation distance is below
+        `tol`. The trajectory is not stored, unless `keep_trajectory` is True.
+
+        Parameters
+        ----------
+        ic: int
+            Initial condition, index of the centroid used as initial condition.
+        tol : float, optional
+            Tolerance on the total variation distance (half of the L1 norm)
+            between two successive checks.
+        t_check : float, optional
+            Time between two checks. Defaults to 100 average transition times.
+        t_max : float, optional
+            Maximum simulation time. Defaults to 1000 `t_check`, so that the
+            propagation stops even if the sampling noise never falls below
+            `tol`. np.inf requires tol > 0.
+        keep_trajectory : bool, optional
+            If True, the visited clusters and their times are also returned
+            (and set as `visited_centroids` and `t_visited`, as with
+            `run()`). Otherwise, None is returned for them.
+        random_state : int or np.random.Generator, optional
+            See `run()`.
+
+        Returns
+        -------
+        q : ndarray of shape (K,)
+            Probability of each cluster.
+        t_end : float
+            Simulation time when the propagation stopped.
+        t_visited : ndarray of shape (n_visits,) or None
+            Time of each visit, if `keep_trajectory` is True.
+        visited_centroids : ndarray of shape (n_visits,) or None
+            Sequence of visited clusters, if `keep_trajectory` is True.
+        """
+
+        print('Starting CNM propagation')
+        print('------------------------')
+        print('Tolerance: {}'.format(tol))
+
+        if t_check is None:
+            t_check = 100 * float(np.mean(self.transition.transition_times))
+        if t_max is None:
+            t_max = 1000 * t_check
+        if tol <= 0 and np.isinf(t_max):
+            raise Exception('A tolerance of {} is never reached, set a finite t_max'.format(tol))
+
+        walk = _Walk(self.transition,ic,random_state,self.sample_times)
+
+        occupancy = np.zeros(self.transition.K)
+        q_previous = None
+        t = 0.
+        t_next_check = t_check
+        current_cl = ic
+        if keep_trajectory:
+            t_visited = [t]
+            visited_centroids = [ic]
+
+        while t < t_max:
+
+            next_cl, transition_time = walk.step()
+
+            # Half of the transition time for each end of the transition
+            occupancy[current_cl] += transition_time / 2.
+            occupancy[next_cl] += transition_time / 2.
+            t += transition_time
+            current_cl = next_cl
+
+            if keep_trajectory:
+                t_visited.append(t)
+                visited_centroids.append(next_cl)
+
+            if t >= t_next_check:
+                q = occupancy / occupancy.sum()
+                if q_previous is not None and np.abs(q - q_previous).sum() / 2. < tol:
+                    break
+                q_previous = q
+                while t_next_check <= t:
+                    t_next_check += t_check
+
+        print('Stopped at t = {}'.format(round(t,3)))
+        print('\n')
+
+        q = occupancy / occupancy.sum()
+        if not keep_trajectory:
+            return q, t, None, None
+
+        t_visited = np.array(t_visited)
+        visited_centroids = np.array(visited_centroids)
+
+        # The last trajectory is also kept, for a single thread
+        self.t_visited, self.visited_centroids = t_visited, visited_centroids
+
+        return q, t, t_visited, visited_centroids
+
+    def _propagate(self,t_total,ic,random_state=None):
+        """Propagate the centroid-to-centroid trajectory.
+
+        Returns
+        -------
+        t: ndarray of shape (n_visits,)
+            Time of each cluster visit.
+        visited_centroids: ndarray of shape (n_visits,)
+            Sequence of visited clusters, starting with `ic`.
         """
 
         print('Starting CNM propagation')
         print('------------------------')
         print('Total time: {}'.format(t_total))
 
-        # Initialize past of ic, finding the first centroid sequence of size L
-        # ending with ic
-        past_found = False
-        for i_cl,cl in enumerate(self.cluster_sequence):
-            if (cl == ic) and (i_cl >= self.L-1):
-                past_cl = self.cluster_sequence[i_cl-self.L+1:i_cl+1]
-                past_found = True
-                break
-        if not past_found:
-            msg = (
-                    "Past not found. You are maybe asking for a too long past. "
-                    "Try again with a shorter past."
-                    )
-            raise Exception(msg)
+        walk = _Walk(self.transition,ic,random_state,self.sample_times)
 
         # Initialize variables
         t = [0]
         visited_centroids = [ic]
 
         # Initialize the progress bar
+        from tqdm import tqdm
         pbar = tqdm(total=10,desc='Propagation progress')
 
         # Propagate iteratively
         while t[-1] < t_total:
 
             # Find the next destination and required time
-            past_cl, next_cl, transition_time = self.transition.step(past_cl)
-
-            # Update the time and past
-            past_cl[:-1] = past_cl[1:]
-            past_cl[-1] = next_cl
+            next_cl, transition_time = walk.step()
             t.append(t[-1] + transition_time)
 
             # Store visited centroid
@@ -115,12 +412,70 @@ class Propagation:
         pbar.close()
         print('\n')
 
+        t = np.array(t)
+        visited_centroids = np.array(visited_centroids)
+
+        # Keep the centroid-level trajectory. The returned arrays are those of
+        # this run, even if another thread propagates meanwhile.
+        self.t_visited, self.visited_centroids = t, visited_centroids
+
+        return t, visited_centroids
+
+    def _interpolate(self,t,visited_centroids,dt):
+        """Interpolate the centroid-to-centroid trajectory, see `interpolation`."""
+
+        if self.interpolation == 'paths':
+            return self.path_library.interpolate(t,visited_centroids,dt)
+
         # Get the corresponding states
-        x_hat = self.centroids[visited_centroids]
+        x = self.centroids[visited_centroids]
+        if self.interpolation == 'spline':
+            return self._interpolate_spline(t,x,dt)
+        return self._interpolate_segments(t,x,dt)
 
+    def _interpolate_segments(self,t,x,dt):
+        """Blend the centroids of each segment on a uniform time grid.
 
-        # Smooth the trajectory
-        return self._interpolate_spline(t,x_hat,dt)
+        Each time of the grid is located in its segment [t_i,t_i+1] with
+        np.searchsorted, and the state is computed in closed form from the
+        centroids (and slopes) at both ends, for all times at once.
+
+        Parameters
+        ----------
+        t, x, dt :
+            See `_interpolate_spline()`.
+
+        Returns
+        -------
+        t_int, x_int :
+            See `_interpolate_spline()`.
+        """
+
+        t_int = np.arange(t[0],t[-1],dt)
+
+        # Segment and relative position of each time
+        i_seg = np.clip(np.searchsorted(t,t_int,side='right') - 1,0,t.size-2)
+        h = (t[i_seg+1] - t[i_seg])[:,None]
+        s = (t_int[:,None] - t[i_seg,None]) / h
+
+        if self.interpolation == 'linear':
+            x_int = x[i_seg] + s * (x[i_seg+1] - x[i_seg])
+            return t_int, x_int.astype(x.dtype)
+
+        # Slopes at the centroids: second-order differences, one-sided at the
+        # ends
+        slopes = np.gradient(x.astype(float),t,axis=0,edge_order=1)
+
+        s2 = s * s
+        s3 = s2 * s
+        x_int = (
+                (2*s3 - 3*s2 + 1) * x[i_seg]
+                + (s3 - 2*s2 + s) * h * slopes[i_seg]
+                + (-2*s3 + 3*s2) * x[i_seg+1]
+                + (s3 - s2) * h * slopes[i_seg+1]
+                )
+
+        return t_int, x_int.astype(x.dtype)
 
     def _interpolate_spline(self,t,x,dt):
         """Interpolate the centroid-to-centroid trajectory with splines.
@@ -151,7 +506,8 @@ class Propagation:
         # Create the interpolated time vector
         t_int = np.arange(t[0],t[-1],dt)
 
-        x_int = np.empty((t_int.size,x.shape[1]))
+        # The trajectory has the type of the centroids
+        x_int = np.empty((t_int.size,x.shape[1]),dtype=x.dtype)
 
         # --> Interpolate
         from scipy.interpolate import InterpolatedUnivariateSpline
@@ -164,6 +520,64 @@ class Propagation:
 
         return t_int, x_int
 
+class _Walk:
+    """State of one propagation: the past of L centroids and the random
+    numbers. The model itself is not modified."""
+
+    def __init__(self,transition,ic,random_state,sample_times):
+
+        self.transition = transition
+        self.random_state = _check_random_state(random_state)
+        self.sample_times = sample_times
+
+        # Initialize past of ic, with the first centroid sequence of size L
+        # ending with ic. The past is copied, as it is updated in place.
+        i_history = transition.initial_history(ic)
+        self.past_cl = transition.histories[i_history].astype(int)
+
+    def step(self):
+        """Move to the next centroid.
+
+        Returns
+        -------
+        next_cl : int
+            Index of the next cluster.
+        transition_time : float
+            Transition time to next_cl.
+        """
+
+        self.past_cl, next_cl, transition_time = self.transition.step(
+                self.past_cl,self.sample_times,self.random_state
+                )
+        self.past_cl[:-1] = self.past_cl[1:]
+        self.past_cl[-1] = next_cl
+
+        return next_cl, transition_time
+
+def _check_random_state(random_state):
+    """Generator from a seed, or the global NumPy state if None."""
+
+    if random_state is None:
+        return np.random
+    if isinstance(random_state,np.random.Generator):
+        return random_state
+    return np.random.default_rng(random_state)
+
+def _spawn(random_state,n):
+    """n independent generators, seeded from `random_state`."""
+
+    if random_state is None:
+        entropy = np.random.randint(2**62)
+    elif isinstance(random_state,np.random.Generator):
+        entropy = int(random_state.integers(2**62))
+    else:
+        entropy = random_state
+
+    return [
+            np.random.default_rng(seed)
+            for seed in np.random.SeedSequence(entropy).spawn(n)
+            ]
+
 if __name__=="__main__":
 
     # Do clustering and transition properties
@@ -189,6 +603,7 @@ if __name__=="__main__":
     from clustering import Clustering
     from transition_properties import TransitionProperties
     clustering = Clustering(**cluster_config)
+    cluster_sequence = clustering.cluster_sequence.copy()
 
     # Test with and without past
     for l in L:
@@ -227,3 +642,161 @@ if __name__=="__main__":
         # test visited centroids
         # assert np.all(propagation.visited_centroids == visited_centroids_test)
 
+        # The propagation leaves the data sequence of the model unchanged
+        assert np.all(transition_properties.cluster_sequence == cluster_sequence)
+
+        # Label-level propagation
+        np.random.seed(0)
+        t_visits, labels_visits = propagation.run_clusters(t_total,ic)
+        assert labels_visits[0] == ic and t_visits[-1] >= t_total
+        t_labels, labels_hat = propagation.run_clusters(t_total,ic,dt)
+        assert t_labels.shape == labels_hat.shape
+        assert np.all(np.isin(labels_hat,propagation.visited_centroids))
+
+    # ensemble propagation: all the steps are transitions of the model
+    trajectories = propagation.run_ensemble(t_total,np.arange(K).repeat(20),random_state=0)
+    for i_real, (t_hat, labels_hat) in enumerate(trajectories):
+        assert labels_hat[0] == i_real // 20
+        assert t_hat[-2] < t_total <= t_hat[-1]
+        assert np.all(np.diff(t_hat) > 0)
+        for i_visit in range(1,labels_hat.size-l):
+            key = ','.join(map(str,labels_hat[i_visit:i_visit+l+1]))
+            assert key in transition_properties.T
+    t_hat, x_hat = propagation.run_ensemble(t_total,[ic],dt,random_state=0)[0]
+    assert x_hat.shape == (t_hat.size,clustering.centroids.shape[1])
+
+    # the batched draws follow the probabilities of the model
+    i_history = transition_properties.initial_history(ic)
+    past_cl, destinations, probabilities, _ = transition_properties.transitions(
+            transition_properties.histories[i_history]
+            )
+    _, next_cl, _ = transition_properties.step_batch(
+            np.full(100000,i_history),np.random.default_rng(0)
+            )
+    frequencies = np.array([np.mean(next_cl == elt) for elt in destinations])
+    np.testing.assert_allclose(frequencies,probabilities,atol=1e-2)
+
+    # propagation with sampled transition times
+    propagation = Propagation(transition_properties,sample_times=True)
+    t_hat, labels_hat = propagation.run_clusters(t_total,ic)
+    assert np.all(np.diff(t_hat) > 0)
+    trajectories = propagation.run_ensemble(t_total,[ic]*10,random_state=0)
+    assert all(np.all(np.diff(t_hat) > 0) for t_hat, _ in trajectories)
+
+    # blending per segment passes through the visited centroids
+    t_visited = np.array([0.,1.,3.,4.])
+    x_visited = np.array([[0.,0.],[1.,2.],[3.,2.],[4.,0.]])
+    for interpolation in ['linear','hermite']:
+        propagation = Propagation(transition_properties,interpolation=interpolation)
+        t_int, x_int = propagation._interpolate_segments(t_visited,x_visited,1.)
+        np.testing.assert_allclose(t_int,[0.,1.,2.,3.])
+        np.testing.assert_allclose(x_int[[0,1,3]],x_visited[:3],atol=1e-12)
+    # slopes of 4/3 and -4/3 at t=1 and t=3 (second-order differences)
+    np.testing.assert_allclose(x_int[2],[2.,2.+2./8*8./3])
+    t_int, x_int = Propagation(transition_properties,interpolation='linear') \
+            ._interpolate_segments(t_visited,x_visited,1.)
+    np.testing.assert_allclose(x_int[2],[2.,2.])
+
+    # the linear blending stays within the range of the centroids
+    np.random.seed(0)
+    propagation = Propagation(transition_properties,interpolation='linear')
+    t_hat, x_hat = propagation.run(t_total,ic,dt)
+    assert x_hat.shape == (t_hat.size,clustering.centroids.shape[1])
+    assert np.all(x_hat >= clustering.centroids.min(axis=0) - 1e-12)
+    assert np.all(x_hat <= clustering.centroids.max(axis=0) + 1e-12)
+
+    # propagation until the cluster probabilities converge, with the same
+    # statistics as computed afterwards from the trajectory
+    from analysis import visit_probability
+    np.random.seed(0)
+    propagation = Propagation(transition_properties)
+    q_hat, t_end, t_kept, labels_kept = propagation.run_until_converged(
+            ic,tol=1e-2,keep_trajectory=True
+            )
+    assert t_end == t_kept[-1]
+    assert np.all(propagation.visited_centroids == labels_kept)
+    np.testing.assert_allclose(q_hat,visit_probability(labels_kept,t_kept,K))
+    np.random.seed(0)
+    q_tight, t_tight, t_none, labels_none = propagation.run_until_converged(ic,tol=1e-3)
+    assert t_tight > t_end and t_none is None and labels_none is None
+    t_long, labels_long = propagation.run_clusters(3000.,ic)
+    q_long = visit_probability(labels_long,t_long,K)
+    assert np.abs(q_tight - q_long).sum() / 2 < 0.02
+    q_short, t_short, _, _ = propagation.run_until_converged(ic,tol=0,t_max=10.)
+    assert 10. <= t_short < 11.
+    q_short, t_short, _, _ = propagation.run_until_converged(ic,tol=0,t_check=1.)
+    assert 1000. <= t_short < 1001.
+    try:
+        propagation.run_until_converged(ic,tol=0,t_max=np.inf)
+        rejected = False
+    except Exception as e:
+        rejected = 'tolerance' in str(e)
+    assert rejected
+
+    # the model is read-only, and the propagations with their own generators
+    # are reproducible, also when run by concurrent threads
+    from concurrent.futures import ThreadPoolExecutor
+    assert not transition_properties.probabilities.flags.writeable
+    propagation = Propagation(transition_properties,sample_times=True)
+    serial = [propagation.run_clusters(t_total,ic,random_state=seed) for seed in range(8)]
+    with ThreadPoolExecutor(4) as pool:
+        threaded = list(pool.map(
+            lambda seed: propagation.run_clusters(t_total,ic,random_state=seed),range(8)
+            ))
+    for (t_serial, labels_serial), (t_threaded, labels_threaded) in zip(serial,threaded):
+        assert np.all(labels_serial == labels_threaded)
+        assert np.all(t_serial == t_threaded)
+
+    # the ensemble split between threads
+    ics = np.arange(K).repeat(20)
+    trajectories = propagation.run_ensemble(t_total,ics,random_state=0,n_jobs=3)
+    assert [labels_hat[0] for _, labels_hat in trajectories] == ics.tolist()
+    assert all(t_hat[-1] >= t_total for t_hat, _ in trajectories)
+    repeated = propagation.run_ensemble(t_total,ics,random_state=0,n_jobs=3)
+    for (_, labels_hat), (_, labels_repeated) in zip(trajectories,repeated):
+        assert np.all(labels_hat == labels_repeated)
+
+    # each thread propagates its chunk of the ensemble with its own
+    # generator, as a single batch would
+    ics = np.arange(K).repeat(400)
+    threaded = propagation.run_ensemble(10.,ics,random_state=0,n_jobs=4)
+    batches = [
+            propagation.run_ensemble(10.,chunk,random_state=random_state)
+            for chunk, random_state in zip(np.array_split(ics,4),_spawn(0,4))
+            ]
+    serial = [trajectory for batch in batches for trajectory in batch]
+    assert len(threaded) == len(serial) == ics.size
+    for (t_hat, labels_hat), (t_serial, labels_serial) in zip(threaded,serial):
+        assert np.all(t_hat == t_serial) and np.all(labels_hat == labels_serial)
+
+    # reconstruction with the average data paths
+    from path_library import PathLibrary
+    library = PathLibrary(clustering,data)
+    propagation = Propagation(transition_properties,interpolation='paths',path_library=library)
+    t_hat, x_hat = propagation.run(t_total,ic,dt,random_state=0)
+    assert x_hat.shape == (t_hat.size,clustering.centroids.shape[1])
+    t_visits, labels_visits = propagation.run_clusters(t_total,ic,random_state=0)
+    on_visit = np.flatnonzero(np.isin(t_hat,t_visits))
+    np.testing.assert_allclose(
+            x_hat[on_visit],clustering.centroids[labels_visits[np.searchsorted(t_visits,t_hat[on_visit])]]
+            )
+
+    # float32 propagation
+    clustering = Clustering(**cluster_config,dtype=np.float32)
+    transition_properties = TransitionProperties(
+            clustering,K,3,dt,dtype=np.float32
+            )
+    t_hat, x_hat = Propagation(transition_properties).run(t_total,ic,dt)
+    assert x_hat.dtype == np.float32
+
+    # Importing the package must not load the heavy dependencies, which are
+    # only needed at first use
+    import subprocess
+    import sys
+    code = (
+            "import sys; sys.path.insert(0, '..'); import cnm; cnm.Propagation; "
+            "heavy = {'sklearn', 'scipy', 'tqdm', 'matplotlib'} & set(sys.modules); "
+            "assert not heavy, 'Eagerly imported: {}'.format(sorted(heavy))"
+            )
+    subprocess.run([sys.executable, '-c', code], check=True)
+
@@ -0,0 +1,199 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+import asyncio
+import numpy as np
+
+class AsyncPropagation:
+    """Serve concurrent propagation requests with batched ensemble steps.
+
+    The requests made while the event loop is busy (or within `max_delay`)
+    are coalesced into one call of `Propagation.run_ensemble()`, executed in
+    an executor so that the event loop is not blocked. The cost of a batch
+    grows with the length of the longest request rather than with the number
+    of requests.
+
+    Attributes
+    ----------
+    propagation : instance
+        Instance from the Propagation class.
+    max_batch_size : int
+        Maximum number of requests per batch.
+    max_delay : float
+        Time (in seconds) a request waits for other requests to join its
+        batch.
+    n_batches : int
+        Number of batches executed so far.
+    """
+
+    def __init__(self,propagation,max_batch_size=1024,max_delay=0.,executor=None):
+        """
+        Parameters
+        ----------
+        propagation : instance
+            Instance from the Propagation class.
+        max_batch_size : int, optional
+            Maximum number of requests per batch.
+        max_delay : float, optional
+            Time (in seconds) a request waits for other requests to join its
+            batch. By default, a batch contains the requests made before the
+            event loop runs again.
+        executor : concurrent.futures.Executor, optional
+            Executor of the batches. Defaults to a single worker thread. The
+            model is read-only, so a pool of several threads can execute
+            batches concurrently. With a process pool, the model is pickled
+            for each batch.
+        """
+
+        self.propagation = propagation
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.n_batches = 0
+
+        if executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(1)
+        self.executor = executor
+
+        self._pending = []
+        self._flush_handle = None
+        self._seeds = np.random.SeedSequence()
+
+    async def run(self,t_total,ic,dt=None):
+        """Propagate one trajectory.
+
+        Parameters
+        ----------
+        t_total : float
+            Total simulation time.
+        ic: int
+            Index of the initial centroid.
+        dt: float, optional
+            Time step of the spline-interpolated trajectory. If not given, the
+            visited clusters are returned.
+
+        Returns
+        -------
+        t_hat, x_hat : ndarray
+            The trajectory, see `Propagation.run_ensemble()`.
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((t_total,ic,dt,future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            if self.max_delay > 0:
+                self._flush_handle = loop.call_later(self.max_delay,self._flush)
+            else:
+                self._flush_handle = loop.call_soon(self._flush)
+
+        return await future
+
+    def _flush(self):
+        """Submit the pending requests, grouped by time step."""
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        pending, self._pending = self._pending, []
+        loop = asyncio.get_running_loop()
+
+        for dt in {request[2] for request in pending}:
+            batch = [request for request in pending if request[2] == dt]
+            t_total = np.array([request[0] for request in batch],dtype=float)
+            ics = np.array([request[1] for request in batch],dtype=int)
+            futures = [request[3] for request in batch]
+
+            # Each batch has its own random numbers
+            random_state = np.random.default_rng(self._seeds.spawn(1)[0])
+
+            task = loop.run_in_executor(
+                    self.executor,
+                    self.propagation.run_ensemble,
+                    t_total,ics,dt,random_state,
+                    )
+            task.add_done_callback(
+                    lambda task, futures=futures: _set_results(task,futures)
+                    )
+            self.n_batches += 1
+
+def _set_results(task,futures):
+    """Dispatch the trajectories of a batch to the requests."""
+
+    if task.exception() is not None:
+        for future in futures:
+            if not future.done():
+                future.set_exception(task.exception())
+        return
+
+    for future, trajectory in zip(futures,task.result()):
+        if not future.done():
+            future.set_result(trajectory)
+
+if __name__=='__main__':
+
+    from sklearn.cluster import KMeans
+    from clustering import Clustering
+    from transition_properties import TransitionProperties
+    from propagation import Propagation
+
+    # CNM config
+    K = 5
+    L = 3
+    dt = 0.016666944449074152
+
+    # Model of the test data
+    data = np.load('test_data/data.npy')
+    cluster_config = {
+            'data': data,
+            'cluster_algo': KMeans(n_clusters=K,max_iter=1000,n_init=100),
+            'dataset': 'dummy'
+            }
+    clustering = Clustering(**cluster_config)
+    transition_properties = TransitionProperties(clustering,K,L,dt)
+
+    # Concurrent requests are served in one batch
+    server = AsyncPropagation(Propagation(transition_properties))
+
+    async def main():
+        requests = [server.run(5.+i_request,i_request % K) for i_request in range(50)]
+        return await asyncio.gather(*requests)
+
+    trajectories = asyncio.run(main())
+    assert server.n_batches == 1
+    for i_request, (t_hat, labels_hat) in enumerate(trajectories):
+        assert labels_hat[0] == i_request % K
+        assert t_hat[-1] >= 5.+i_request
+
+    # Requests with different time steps are batched separately
+    async def main():
+        requests = [server.run(5.,0,dt),server.run(5.,1),server.run(5.,2,dt)]
+        return await asyncio.gather(*requests)
+
+    trajectories = asyncio.run(main())
+    assert server.n_batches == 3
+    assert trajectories[0][1].shape[1] == data.shape[1]
+    assert trajectories[1][1].ndim == 1
@@ -23,8 +23,7 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from itertools import groupby
-from sklearn.neighbors import KDTree
+import os
 
 
 class TransitionProperties:
@@ -33,33 +32,70 @@ class TransitionProperties:
     Attributes
     ----------
     clustering : instance
-        Instance from the Clustering class.
+        Instance from the Clustering class. None (as `cluster_sequence` and
+        `run_lengths`) for a model rebuilt with `from_arrays()`.
     K : int
         Number of clusters.
     L : int
         CNM model order
     dt : float
         Time step of the data.
-    labels : ndarray of shape (n_snapshots,)
-        Cluster affiliation of each snapshot.
+    dtype : dtype
+        Floating point type of the probabilities and transition times.
     centroids : ndarray of shape (K,n_dim)
         Centroids of the clusters.
     cluster_sequence : ndarray of shape (# transition+1,)
         Sequence of visited clusters.
+    run_lengths : ndarray of shape (# transition+1,)
+        Number of snapshots of each visit of `cluster_sequence`.
+    min_count : int
+        Minimum number of occurrences of a past of L centroids, below which it
+        backs off to its longest suffix occurring at least min_count times.
+    smoothing : float
+        Strength of the Dirichlet smoothing of the probabilities towards the
+        first-order model.
+    histories : ndarray of shape (n_histories,L)
+        The distinct pasts of L centroids (oldest first) found in the data, in
+        order of first occurrence. A past shortened by `min_count` is padded
+        with -1 on the left.
+    indptr : ndarray of shape (n_histories+1,)
+        The possible transitions of histories[i] are the entries
+        indptr[i]:indptr[i+1] of `destinations`, `probabilities` and
+        `transition_times`.
+    destinations : ndarray of shape (n_transitions,)
+        Index of the destination centroid of each transition, stored as int16
+        (or int32 for large K).
+    probabilities : ndarray of shape (n_transitions,)
+        Probability of each transition, given its history.
+    transition_times : ndarray of shape (n_transitions,)
+        Average transition time of each transition, given its history.
+    transition_counts : ndarray of shape (n_transitions,)
+        Number of occurrences of each transition in the data.
+    transition_time_m2 : ndarray of shape (n_transitions,)
+        Sum of the squared deviations of the transition times from their
+        average, so that the variance is transition_time_m2/transition_counts.
+    time_bin_edges : ndarray of shape (time_bins+1,) or None
+        Edges of the bins of the transition time histograms, if any.
+    time_histograms : ndarray of shape (n_transitions,time_bins) or None
+        Histogram of the transition times of each transition, if any.
+    n_histories : int
+        Number of rows of `histories`.
+    nbytes : int
+        Memory footprint of the tables, in bytes.
     Q : dict
         Transition probabilities for an L-order model.  The keys of Q are string
         of the past centroids. If the previously visited centroids are 3
         (newest), 2, and 1 (oldest), the key will be '1,2,3'. The corresponding
         values are 2D arrays, where the first column is the index of the
         possible destination centroid and the 2 column is the corresponding
-        probability.
+        probability. Q is a view of the arrays above, built at first access.
     T : dict
         Transition times for an L-order model. The keys of T are string
         of the past centroids and the future one. If the previously visited centroids are 3
         (newest), 2, and 1 (oldest), and the next destination is 4, the key will
         be '1,2,3,4'. The corresponding
         values are the transition time of the transition 3->4, having visited 1
-        and 2 before..
+        and 2 before. T is a view of the arrays above, built at first access.
 
     Notes
     -----
@@ -75,35 +111,150 @@ class TransitionProperties:
     The requests to T are always done with one more key than the requests to Q.
     The transition to the final cluster is neglected, because the transition is
     not complete, so the corresponding time would be wrong.
+
+    The model is immutable once fitted: the tables are read-only and the
+    propagation state (the past and the random numbers) is passed to each
+    call of `step()` or `step_batch()`. One model can therefore be used by
+    several threads at once.
     """
 
-    def __init__(self, clustering, K: int, L: int, dt):
+    def __init__(self, clustering, K: int, L: int, dt, dtype=np.float64,
+                 time_bins=None, min_count=1, smoothing=0., cache=False,
+                 _force_hash=None):
+        """
+        Parameters
+        ----------
+        clustering : instance
+            Instance from the Clustering class.
+        K : int
+            Number of clusters.
+        L : int
+            CNM model order.
+        dt : float
+            Time step of the data.
+        dtype : dtype, optional
+            Floating point type of the probabilities and transition times,
+            e.g., np.float32 to halve the memory of the model.
+        time_bins : int, optional
+            If given, a histogram of the transition times with `time_bins`
+            bins (common to all transitions) is stored for each transition.
+        min_count : int, optional
+            Pasts of L centroids occurring less than `min_count` times are
+            pruned: they are replaced by their longest suffix occurring at
+            least `min_count` times (at least the current centroid), whose
+            transitions are estimated from all its occurrences. A past
+            reached during the propagation backs off in the same way. This
+            limits the size of the tables and the overfitting for large L.
+        smoothing : float, optional
+            If > 0, the probabilities of a past with n occurrences are
+            (n_j + smoothing*p_j) / (n + smoothing), where n_j is the number
+            of transitions to j and p_j the first-order probability of the
+            transition from the current centroid to j. The first-order
+            destinations not observed after the past are added, with the
+            transition time statistics of the first-order transition.
+        cache : bool, optional
+            If True, the tables are saved in the folder of the clustering
+            (see `Clustering.data_folder`), keyed by a hash of the cluster
+            sequence, of its run lengths and of all the parameters above, and
+            read instead of being computed when the same model is requested
+            again.
+        _force_hash : int, optional
+            Odd base of hashed codes, used even if the exact codes fit. Only
+            for testing the hashed codes, see `row_codes()`.
+        """
 
         print('Identify the transition properties')
         print('----------------------------------')
         print('Model order: {}'.format(L))
 
         self.clustering = clustering
-        self.centroids = clustering.centroids
-        self.labels = clustering.labels
         self.cluster_sequence = clustering.cluster_sequence
+        self.run_lengths = clustering.run_lengths
         self.K = K
         self.L = L
         self.dt = dt
+        self.dtype = np.dtype(dtype)
+        self.time_bins = time_bins
+        self.min_count = min_count
+        self.smoothing = smoothing
+        self._force_hash = _force_hash
+        self._centroids = None
 
         # Safety check
         if self.L <= 0:
             raise Exception('The model order must be > 0')
 
-        print('Compute Q')
-        self.Q = self._compute_Q()
+        cache_path = self._cache_path() if cache else None
+        if cache_path is not None and os.path.exists(cache_path):
+            print('Read from {}'.format(cache_path))
+            with np.load(cache_path) as arrays:
+                self._set_tables({name: arrays[name] for name in arrays.files})
 
-        print('Compute T')
-        self.T = self._compute_T()
+        else:
+            print('Compute Q')
+            self._compute_Q()
 
+            print('Compute T')
+            self._compute_T()
+
+            if cache_path is not None:
+                print('Save in {}'.format(cache_path))
+                self._save_cache(cache_path)
+
+        self._freeze()
+
+        print('Number of histories: {}'.format(self.n_histories))
+        print('Memory footprint: {:.3g} MB'.format(self.nbytes / 1e6))
         print('\n')
 
-    def step(self,past_cl):
+    @property
+    def centroids(self):
+        if self.clustering is None:
+            return self._centroids
+        return self.clustering.centroids
+
+    @property
+    def n_histories(self):
+        return self.histories.shape[0]
+
+    @property
+    def nbytes(self):
+        return sum(
+                getattr(self,name).nbytes for name in _table_names
+                if getattr(self,name) is not None
+                )
+
+    @property
+    def transition_time_var(self):
+        """Variance of the transition time of each transition."""
+        return self.transition_time_m2 / self.transition_counts
+
+    @property
+    def Q(self):
+        if self._Q is None:
+            self._Q = {
+                    key: np.column_stack((
+                        self.destinations[start:stop],
+                        self.probabilities[start:stop],
+                        ))
+                    for key, start, stop in zip(
+                        self._history_keys(),self.indptr[:-1],self.indptr[1:]
+                        )
+                    }
+        return self._Q
+
+    @property
+    def T(self):
+        if self._T is None:
+            self._T = {}
+            for key, start, stop in zip(
+                    self._history_keys(),self.indptr[:-1],self.indptr[1:]):
+                for i in range(start,stop):
+                    self._T[key+',{}'.format(self.destinations[i])] = \
+                            self.transition_times[i]
+        return self._T
+
+    def step(self,past_cl,sample_time=False,random_state=np.random):
         """Find the next centroid and corresponding transition time.
 
         Parameters
@@ -111,6 +262,13 @@ class TransitionProperties:
         past_cl : list of length L
             Contains the current and previous centroids. With L=3,
             past_cl=[c_i,c_j,c_k] (in the case where c_l is the destination)
+        sample_time : bool, optional
+            If True, the transition time is drawn from the distribution of the
+            transition times, see `sample_transition_times()`, instead of
+            using their average.
+        random_state : np.random.Generator or module, optional
+            Source of the random numbers. Defaults to the global NumPy state.
+            Each thread should use its own generator.
 
         Returns
         -------
@@ -119,7 +277,8 @@ class TransitionProperties:
             differ from the input parameter `past_cl` in the case where
             past_cl[-1] has not possible destination. In that case, the method 
             _get_next_cl_from_neighbor(past_cl) will find a new `past_cl`, as
-            close as possible to the original one.
+            close as possible to the original one. If the past was pruned
+            (see `min_count`), its retained suffix padded with -1 is returned.
         next_cl : int
             Index of the next cluster
         transition_time : float
@@ -127,24 +286,533 @@ class TransitionProperties:
         """
 
         # Select next cluster
-        try:
-            key = ','.join(map(str, past_cl))
-            next_cl = int(np.random.choice(self.Q[key][:,0], p=self.Q[key][:,1]))
+        past_cl, i_history = self._find_history(past_cl)
+        start, stop = self.indptr[i_history], self.indptr[i_history+1]
+        i_transition = start + random_state.choice(
+                stop-start, p=self.probabilities[start:stop]
+                )
+        next_cl = int(self.destinations[i_transition])
+
+        # Read the corresponding transition time
+        if sample_time:
+            transition_time = float(
+                    self.sample_transition_times(i_transition,random_state)
+                    )
+        else:
+            transition_time = float(self.transition_times[i_transition])
+
+        return past_cl, next_cl, transition_time
+
+    def step_batch(self,i_histories,random_state=np.random,sample_time=False):
+        """Find the next centroids of many independent trajectories at once.
+
+        The trajectories are identified by the row of their past in
+        `histories`. The next centroids are drawn by inverting the cumulative
+        probabilities of all the rows in a single np.searchsorted.
+
+        Parameters
+        ----------
+        i_histories : ndarray of shape (n,)
+            Row of the past of each trajectory in `histories`.
+        random_state : np.random.Generator or module, optional
+            Source of the random numbers. Defaults to the global NumPy state.
+        sample_time : bool, optional
+            See `step()`.
+
+        Returns
+        -------
+        i_histories : ndarray of shape (n,)
+            Row of the updated past (including the next centroid) of each
+            trajectory. If a past has no possible destination, the past of a
+            neighbor is used, see `step()`.
+        next_cl : ndarray of shape (n,)
+            Index of the next cluster of each trajectory.
+        transition_time : ndarray of shape (n,)
+            Transition time to the next cluster of each trajectory.
+        """
+
+        cumulative, next_history = self._get_batch_tables()
+
+        i_histories = np.asarray(i_histories)
+        u = random_state.random(i_histories.shape)
+        i_transitions = np.searchsorted(cumulative,i_histories + u,side='right')
+
+        # Guard against the rounding of the sum for the last transition of a row
+        i_transitions = np.minimum(i_transitions,self.indptr[i_histories+1]-1)
+
+        if sample_time:
+            transition_time = self.sample_transition_times(i_transitions,random_state)
+        else:
+            transition_time = self.transition_times[i_transitions]
+
+        return (
+                next_history[i_transitions],
+                self.destinations[i_transitions],
+                transition_time,
+                )
+
+    def sample_transition_times(self,i_transitions,random_state=np.random):
+        """Draw transition times from their distribution in the data.
+
+        With histograms (see `time_bins`), a bin is drawn with the probability
+        of its count, then a time uniformly within the bin. Otherwise, the
+        time is drawn from the gamma distribution with the stored mean and
+        variance.
+
+        Parameters
+        ----------
+        i_transitions : int or ndarray of shape (n,)
+            Index of the transitions.
+        random_state : np.random.Generator or module, optional
+            Source of the random numbers. Defaults to the global NumPy state.
+
+        Returns
+        -------
+        transition_time : float or ndarray of shape (n,)
+            Drawn transition times.
+        """
+
+        i_transitions = np.asarray(i_transitions)
+
+        if self.time_histograms is not None:
+            cumulative = np.cumsum(self.time_histograms[i_transitions],axis=-1)
+            u = random_state.random(i_transitions.shape) * cumulative[...,-1]
+            bins = np.sum(cumulative <= u[...,None],axis=-1)
+            widths = np.diff(self.time_bin_edges)
+
+            return self.time_bin_edges[bins] \
+                    + random_state.random(i_transitions.shape) * widths[bins]
+
+        # Gamma distribution with the same mean and variance
+        mean = self.transition_times[i_transitions].astype(float)
+        var = self.transition_time_var[i_transitions].astype(float)
+        spread = var > 0
+        transition_time = np.array(mean)
+        transition_time[spread] = random_state.gamma(
+                mean[spread]**2 / var[spread],var[spread] / mean[spread]
+                )
+
+        return transition_time if transition_time.ndim else transition_time.item()
+
+    def transition_time_quantile(self,q):
+        """Quantile of the transition time of each transition.
+
+        The quantile is interpolated linearly within the bins of the
+        histograms, which must be stored (see `time_bins`).
+
+        Parameters
+        ----------
+        q : float
+            Quantile, between 0 and 1.
+
+        Returns
+        -------
+        quantile : ndarray of shape (n_transitions,)
+            Quantile q of the transition time of each transition.
+        """
+
+        if self.time_histograms is None:
+            raise Exception('The quantiles require the histograms, set time_bins')
+
+        histograms = self.time_histograms
+        cumulative = np.cumsum(histograms,axis=1)
+        target = q * cumulative[:,-1]
+
+        # First bin reaching the target
+        bins = np.minimum(np.sum(cumulative < target[:,None],axis=1),histograms.shape[1]-1)
+        rows = np.arange(histograms.shape[0])
+        count = histograms[rows,bins]
+        below = cumulative[rows,bins] - count
+        fraction = np.where(count > 0,(target - below) / np.maximum(count,1),0.)
+
+        return self.time_bin_edges[bins] + fraction * np.diff(self.time_bin_edges)[bins]
+
+    def initial_history(self,ic):
+        """Row in `histories` of the first past of the data ending with ic.
+
+        Parameters
+        ----------
+        ic : int
+            Index of the current centroid.
+
+        Returns
+        -------
+        i_history : int
+            Row of the past in `histories`.
+        """
+
+        rows = np.flatnonzero(self.histories[:,-1] == ic)
+        if rows.size == 0:
+            msg = (
+                    "Past not found. You are maybe asking for a too long past. "
+                    "Try again with a shorter past."
+                    )
+            raise Exception(msg)
+
+        return rows[0]
+
+    def transitions(self,past_cl):
+        """Possible transitions after a past.
+
+        Parameters
+        ----------
+        past_cl : list of length L
+            Contains the current and previous centroids.
+
+        Returns
+        -------
+        past_cl : list of length L
+            The past used for the lookup. It differs from the input parameter
+            if past_cl[-1] has no possible destination, see `step()`.
+        destinations : ndarray of shape (n,)
+            Index of the possible next clusters.
+        probabilities : ndarray of shape (n,)
+            Probability of each destination.
+        transition_times : ndarray of shape (n,)
+            Transition time to each destination.
+        """
+
+        past_cl, i_history = self._find_history(past_cl)
+        transitions = slice(self.indptr[i_history],self.indptr[i_history+1])
+
+        return (
+                past_cl,
+                self.destinations[transitions],
+                self.probabilities[transitions],
+                self.transition_times[transitions],
+                )
+
+    def to_arrays(self):
+        """Arrays needed to propagate the model, see `from_arrays()`.
+
+        Returns
+        -------
+        arrays : dict of ndarrays
+            The tables, the centroids, the tables of `step_batch()` and the
+            sorted codes of the histories.
+        """
+
+        cumulative, next_history = self._get_batch_tables()
+        arrays = {
+                'centroids': np.asarray(self.centroids),
+                'cumulative': cumulative,
+                'next_history': next_history,
+                'history_codes': self._history_codes,
+                'history_order': self._history_order,
+                }
+        for name in _table_names:
+            if getattr(self,name) is not None:
+                arrays[name] = getattr(self,name)
+
+        return arrays
+
+    @classmethod
+    def from_arrays(cls,arrays,L,dt):
+        """Rebuild a model from its arrays, without the data.
+
+        The model can be propagated and scored, but the data (clustering,
+        cluster_sequence and run_lengths) is not available.
+
+        Parameters
+        ----------
+        arrays : dict of ndarrays
+            Arrays of the model, see `to_arrays()`. They are used without
+            copy, through read-only views.
+        L : int
+            CNM model order.
+        dt : float
+            Time step of the data.
+
+        Returns
+        -------
+        transition_properties : instance
+            The model.
+        """
+
+        self = cls.__new__(cls)
+        self.clustering = None
+        self.cluster_sequence = None
+        self.run_lengths = None
+        self._centroids = arrays['centroids']
+        self.K = self._centroids.shape[0]
+        self.L = L
+        self.dt = dt
+        self.dtype = arrays['probabilities'].dtype
+        self.min_count = None
+        self.smoothing = None
+        self._force_hash = None
+
+        self._set_tables(arrays)
+        self.time_bins = None if self.time_histograms is None \
+                else self.time_histograms.shape[1]
+
+        if 'cumulative' in arrays:
+            self._batch_tables = arrays['cumulative'], arrays['next_history']
+        self._freeze()
+
+        return self
+
+    def share(self):
+        """Publish the model in shared memory.
+
+        All the arrays of `to_arrays()` are copied into one shared memory
+        block, which other processes attach with `attach()` without copy. The
+        caller owns the block, and must close and unlink it when the model is
+        not needed anymore.
+
+        Returns
+        -------
+        shared : multiprocessing.shared_memory.SharedMemory
+            The shared memory block.
+        spec : dict
+            Description of the shared model, to pass to `attach()`. It can be
+            pickled.
+        """
+
+        from multiprocessing import shared_memory
+
+        arrays = self.to_arrays()
+
+        # Layout of the arrays in the block, aligned on 64 bytes
+        layout = []
+        size = 0
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            layout.append((name,array.dtype.str,array.shape,size))
+            size += -(-array.nbytes // 64) * 64
+
+        shared = shared_memory.SharedMemory(create=True,size=max(size,1))
+        for name, dtype, shape, offset in layout:
+            np.ndarray(shape,dtype,buffer=shared.buf,offset=offset)[...] = arrays[name]
+
+        spec = {
+                'name': shared.name,
+                'tracker': _resource_tracker_id(),
+                'L': self.L,
+                'dt': self.dt,
+                'layout': layout,
+                }
+
+        return shared, spec
+
+    @classmethod
+    def attach(cls,spec):
+        """Attach a model published with `share()`.
+
+        The arrays of the model are read-only views of the shared memory, so
+        attaching costs neither time nor memory per process. The process may
+        be a child of the owner or not: the block is only unlinked by the
+        owner.
+
+        Parameters
+        ----------
+        spec : dict
+            Description of the shared model, returned by `share()`.
+
+        Returns
+        -------
+        transition_properties : instance
+            The model, see `from_arrays()`.
+        """
+
+        import sys
+        from multiprocessing import resource_tracker, shared_memory
+
+        if sys.version_info >= (3,13):
+            shared = shared_memory.SharedMemory(name=spec['name'],track=False)
+        else:
+            # The block is registered with the resource tracker of this
+            # process, which unlinks it at exit if it is not the one of the
+            # owner and of its children
+            shared = shared_memory.SharedMemory(name=spec['name'])
+            if _resource_tracker_id() != spec['tracker']:
+                resource_tracker.unregister(shared._name,'shared_memory')
+        arrays = {}
+        for name, dtype, shape, offset in spec['layout']:
+            array = np.ndarray(shape,dtype,buffer=shared.buf,offset=offset)
+            array.flags.writeable = False
+            arrays[name] = array
+
+        self = cls.from_arrays(arrays,spec['L'],spec['dt'])
+
+        # Keep the block open as long as the model
+        self._shared_memory = shared
+
+        return self
+
+    def score(self,cluster_sequence,run_lengths=None):
+        """Log-likelihood of an observed cluster sequence under the model.
+
+        Parameters
+        ----------
+        cluster_sequence : ndarray of shape (n_visits,)
+            Sequence of visited clusters, e.g., from the labels of held-out
+            data. As for the model, the transition to the final cluster is
+            neglected.
+        run_lengths : ndarray of shape (n_visits,), optional
+            Number of snapshots of each visit. Needed for the transition time
+            error.
+
+        Returns
+        -------
+        scores : dict
+            See `score_batch()`, with scalar values.
+        """
+
+        run_lengths = None if run_lengths is None else [run_lengths]
+        scores = self.score_batch([cluster_sequence],run_lengths)
+
+        return {key: value[0] for key, value in scores.items()}
+
+    def score_batch(self,cluster_sequences,run_lengths=None):
+        """Log-likelihood of many observed cluster sequences at once.
+
+        The pasts of all the sequences are matched with `histories` through
+        their codes, see `history_codes()`. Pruned pasts are scored
+        with their retained suffix. Transitions whose past is not in the model
+        are not scored. Transitions not in the model whose past is have a
+        probability of zero, so the log-likelihood is -inf.
+
+        Parameters
+        ----------
+        cluster_sequences : list of ndarrays
+            Sequences of visited clusters, see `score()`.
+        run_lengths : list of ndarrays, optional
+            Number of snapshots of each visit of each sequence.
+
+        Returns
+        -------
+        scores : dict of ndarrays of shape (n_sequences,)
+            'log_likelihood': sum of the log-probabilities of the transitions
+            whose past is in the model. 'log_likelihood_per_step': the same,
+            divided by their number. 'perplexity': exp(-log_likelihood_per_step).
+            'n_transitions': number of transitions. 'n_known': number of
+            transitions whose past is in the model. 'n_found': number of
+            transitions in the model. 'time_rmse': root mean square error of
+            the transition times of the transitions in the model, NaN without
+            run lengths.
+        """
+
+        L = self.L
+        if run_lengths is None:
+            run_lengths = [None] * len(cluster_sequences)
+
+        # Past and destination of each transition, with the observed time
+        windows, codes, times, n_windows = [], [], [], []
+        for cluster_sequence, n_steps in zip(cluster_sequences,run_lengths):
+            cluster_sequence = np.asarray(cluster_sequence)
+            n = max(cluster_sequence.size - L - 1,0)
+            windows.append(np.lib.stride_tricks.sliding_window_view(
+                cluster_sequence[:-1],L+1
+                ) if n else np.empty((0,L+1),dtype=self.histories.dtype))
+            codes.append(self.history_codes(cluster_sequence[:-1])[:n])
+            if n_steps is None:
+                times.append(np.full(n,np.nan))
+            else:
+                n_steps = np.asarray(n_steps)
+                times.append((n_steps[L-1:L-1+n] + n_steps[L:L+n]) / 2. * self.dt)
+            n_windows.append(n)
+        windows = np.concatenate(windows)
+        codes = np.concatenate(codes)
+        times = np.concatenate(times)
+        n_windows = np.array(n_windows)
+        sequence_of_window = np.repeat(np.arange(n_windows.size),n_windows)
+
+        # Look up the pasts and the transitions in the model
+        history_of_transition = np.repeat(
+                np.arange(self.histories.shape[0]),np.diff(self.indptr)
+                )
+        i_histories = self._history_rows(windows[:,:L],codes)
+        known = i_histories >= 0
+
+        # The transitions are sorted by history and destination
+        transition_keys = history_of_transition * self.K + self.destinations
+        keys = i_histories * self.K + windows[:,L]
+        i_transitions = np.minimum(
+                np.searchsorted(transition_keys,keys),transition_keys.size-1
+                )
+        found = known & (transition_keys[i_transitions] == keys)
+        i_transitions[~found] = -1
+
+        log_probability = np.where(found,0.,-np.inf)
+        log_probability[found] = np.log(self.probabilities[i_transitions[found]])
+        log_probability[~known] = 0.
+        squared_error = np.zeros(times.size)
+        squared_error[found] = (
+                times[found] - self.transition_times[i_transitions[found]]
+                )**2
+
+        def per_sequence(weights):
+            return np.bincount(sequence_of_window,weights,minlength=n_windows.size)
+
+        log_likelihood = per_sequence(log_probability)
+        n_known = per_sequence(known).astype(int)
+        n_found = per_sequence(found).astype(int)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            log_likelihood_per_step = log_likelihood / n_known
+            time_rmse = np.sqrt(per_sequence(squared_error) / n_found)
+
+        return {
+                'log_likelihood': log_likelihood,
+                'log_likelihood_per_step': log_likelihood_per_step,
+                'perplexity': np.exp(-log_likelihood_per_step),
+                'n_transitions': n_windows,
+                'n_known': n_known,
+                'n_found': n_found,
+                'time_rmse': time_rmse,
+                }
+
+    def _find_history(self,past_cl):
+        """Index of the history `past_cl`, see `step()`.
+
+        Returns
+        -------
+        past_cl : list of length L
+            The past, replaced by its retained suffix if it was pruned, or by a
+            neighbor past if it is not in the data.
+        i_history : int
+            Row of past_cl in `histories`.
+        """
+
+        i_history = self._find_row(past_cl)
 
-        except KeyError:
+        if i_history is None:
+
+            # Longest retained suffix of a pruned past
+            if self._pruned:
+                for l in range(self.L-1,0,-1):
+                    suffix = [-1] * (self.L-l) + list(past_cl[self.L-l:])
+                    if min(suffix[self.L-l:]) < 0:
+                        continue
+                    i_history = self._find_row(suffix)
+                    if i_history is not None:
+                        return self.histories[i_history].astype(int), i_history
 
             # The current centroid has no next centroid (data is too short or
             # too many centroids)
             past_cl = self._get_next_cl_from_neighbor(past_cl)
-            key = ','.join(map(str, past_cl))
+            i_history = self._find_row(past_cl)
 
-            next_cl = int(np.random.choice(self.Q[key][:,0], p=self.Q[key][:,1]))
+        return past_cl, i_history
 
-        # Read the corresponding transition time
-        key = ','.join(map(str, past_cl))+',{}'.format(str(next_cl))
-        transition_time = self.T[key]
+    def _find_row(self,past_cl):
+        """Row of the past in `histories`, or None."""
 
-        return past_cl, next_cl, transition_time
+        code = 0
+        for elt in past_cl:
+            code = (code * self._code_base + int(elt) + 1) & _code_mask
+        code = np.uint64(code)
+
+        position = np.searchsorted(self._history_codes,code)
+        if position == self._history_codes.size or self._history_codes[position] != code:
+            return None
+        i_history = int(self._history_order[position])
+
+        # A hashed code may collide with a past not in the model
+        if not self._exact_codes and np.any(self.histories[i_history] != past_cl):
+            return None
+
+        return i_history
 
     def _get_next_cl_from_neighbor(self,past_cl):
         """Finds the next destination centroid from another trajectory.
@@ -180,92 +848,680 @@ class TransitionProperties:
         """
 
         # Find the nearest neighbor
+        from sklearn.neighbors import KDTree
         tree = KDTree(self.centroids)
         dist, ind = tree.query(self.centroids[past_cl[-1],:][None,...],2)
         ind = ind[0,-1]
 
         # Find the possible pasts of this nearest neighbor
-        possible_pasts = []
-        for k in self.Q.keys():
-            past = list(map(int, k.split(',')))
-            if past[-1] == ind:
-                possible_pasts.append(past)
+        possible_pasts = self.histories[self.histories[:,-1] == ind]
 
         # Assume only one
-        return possible_pasts[0]
+        return possible_pasts[0].astype(int)
+
+
+    def history_codes(self,cluster_sequence):
+        """Codes of all the pasts of L clusters of a sequence.
+
+        The code of a past is the number with the digits c+1 (so that the
+        padding -1 is 0) in base K+1, if (K+1)**L fits in 64 bits. Otherwise,
+        it is a polynomial hash modulo 2**64, and the pasts found by their
+        code are compared with `histories` to detect collisions. The codes of
+        all the windows are computed in O(n), see `window_codes()`.
+
+        Parameters
+        ----------
+        cluster_sequence : ndarray of shape (n,)
+            Sequence of visited clusters.
+
+        Returns
+        -------
+        codes : ndarray of shape (n-L+1,)
+            Code of the past cluster_sequence[i:i+L], as stored in
+            `histories`.
+        """
+
+        return window_codes(
+                cluster_sequence,self.L,self.K,self._exact_codes,self._force_hash
+                )
+
+    def _history_rows(self,pasts,codes=None):
+        """Row in `histories` of each past, or -1.
+
+        Pruned pasts are looked up with their longest retained suffix, see
+        `min_count`.
+
+        Parameters
+        ----------
+        pasts : ndarray of shape (n,L)
+            The pasts, possibly padded with -1.
+        codes : ndarray of shape (n,), optional
+            Codes of the pasts, see `history_codes()`.
+
+        Returns
+        -------
+        rows : ndarray of shape (n,)
+            Row of each past.
+        """
+
+        if codes is None:
+            codes = row_codes(pasts,self.K,self._exact_codes,self._force_hash)
+        rows = _lookup_codes(
+                self.histories,self._history_codes,self._history_order,
+                pasts,codes,self._exact_codes,
+                )
+
+        if self._pruned:
+            for l in range(self.L-1,0,-1):
+                missing = np.flatnonzero(rows < 0)
+                if missing.size == 0:
+                    break
+                suffixes = np.array(pasts[missing])
+                suffixes[:,:self.L-l] = -1
+                rows[missing] = _lookup_codes(
+                        self.histories,self._history_codes,self._history_order,
+                        suffixes,
+                        row_codes(suffixes,self.K,self._exact_codes,self._force_hash),
+                        self._exact_codes,
+                        )
+
+        return rows
+
+    def _get_batch_tables(self):
+        """Tables of `step_batch()`, built at first use.
+
+        Returns
+        -------
+        cumulative : ndarray of shape (n_transitions,)
+            Row of the history plus the cumulative probability of the
+            transitions of the history, so that the rows are sorted.
+        next_history : ndarray of shape (n_transitions,)
+            Row in `histories` of the past after each transition.
+        """
+
+        if self._batch_tables is None:
 
+            n_histories = self.histories.shape[0]
+            n_per_history = np.diff(self.indptr)
+            history_of_transition = np.repeat(np.arange(n_histories),n_per_history)
+
+            # Cumulative probabilities within each history, ending exactly at 1
+            cumsum = np.cumsum(self.probabilities,dtype=np.float64)
+            offset = np.concatenate(([0.],cumsum))[self.indptr[:-1]]
+            cumsum -= np.repeat(offset,n_per_history)
+            cumsum /= np.repeat(cumsum[self.indptr[1:]-1],n_per_history)
+            cumulative = history_of_transition + cumsum
+            cumulative[self.indptr[1:]-1] = np.arange(1,n_histories+1)
+
+            # Match the past after each transition with the histories
+            next_pasts = np.column_stack((
+                self.histories[history_of_transition,1:],self.destinations
+                ))
+            next_history = self._history_rows(next_pasts)
+
+            # Pasts without destination continue from a neighbor past
+            for i_transition in np.flatnonzero(next_history < 0):
+                next_history[i_transition] = \
+                        self._find_history(next_pasts[i_transition])[1]
+
+            self._batch_tables = cumulative, next_history
+
+        return self._batch_tables
 
     def _compute_Q(self):
-        """Compute the direct transition matrix of order L."""
+        """Compute the direct transition matrix of order L.
+
+        The sequences of L+1 clusters (past and destination) are grouped by
+        their codes, see `window_codes()`. The histories are ordered by first
+        occurrence, and their possible destinations by index.
+        """
+
+        # All the sequences of past and next cluster. The transition to the
+        # final cluster is neglected.
+        sequence = self.cluster_sequence[:-1].astype(_id_dtype(self.K))
+        windows = np.lib.stride_tricks.sliding_window_view(sequence, self.L+1)
+        contexts, window_of_context, codes = self._prune(sequence,windows)
+
+        transitions, first, inverse, counts = _unique_rows(
+                contexts, codes, self._codes_exact(self.L+1)
+                )
+
+        # The transitions are sorted, so that those of a history are contiguous
+        new_history = np.ones(transitions.shape[0],dtype=bool)
+        new_history[1:] = np.any(transitions[1:,:-1] != transitions[:-1,:-1],axis=1)
+        history_of_transition = np.cumsum(new_history) - 1
+
+        # Order the histories by first occurrence, keeping the destinations
+        # sorted
+        history_first = np.minimum.reduceat(first,np.flatnonzero(new_history))
+        history_rank = np.argsort(np.argsort(history_first,kind='stable'))
+        order = np.argsort(history_rank[history_of_transition],kind='stable')
+        transitions = transitions[order]
+        counts = counts[order]
+        new_history = new_history[order]
+
+        # Map the windows to the reordered transitions
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        self._transition_of_context = rank[inverse]
+        self._window_of_context = window_of_context
+        self._windows = windows
+
+        # Fill the tables
+        starts = np.flatnonzero(new_history)
+        self.histories = transitions[starts,:-1]
+        self.indptr = np.append(starts,transitions.shape[0])
+        self.destinations = transitions[:,-1]
+
+        history_counts = np.add.reduceat(counts,starts)
+        self.probabilities = (
+                counts / np.repeat(history_counts,np.diff(self.indptr))
+                ).astype(self.dtype)
+
+        self._index_histories()
+        self._batch_tables = None
+
+    def _set_tables(self,arrays):
+        """Set the tables from their arrays, see `to_arrays()`."""
+
+        for name in _table_names:
+            setattr(self,name,arrays.get(name))
+
+        self._index_histories(arrays.get('history_codes'),arrays.get('history_order'))
+        self._batch_tables = None
+
+    def _cache_path(self):
+        """File of the cached tables, see `cache`."""
+
+        import hashlib
 
-        # Initialize the past as the first L centroids
-        past_cl = self.cluster_sequence[:self.L].astype(int)
-        Q = {}
+        digest = hashlib.sha1(repr((
+            self.K,self.L,float(self.dt),self.dtype.str,self.time_bins,
+            self.min_count,float(self.smoothing),
+            )).encode())
+        for array in (self.cluster_sequence,self.run_lengths):
+            digest.update(np.ascontiguousarray(array,dtype=np.int64).tobytes())
 
-        for next_cl in self.cluster_sequence[self.L:-1]:
+        return os.path.join(
+                self.clustering.data_folder,
+                'transitions-L{}-{}.npz'.format(self.L,digest.hexdigest()[:16]),
+                )
 
-            key = ','.join(map(str, past_cl))
+    def _save_cache(self,cache_path):
+        """Write the tables to a temporary file, then move it to `cache_path`,
+        so that concurrent jobs never read a partially written cache."""
 
-            # Make sure the key exists (and the value is a list)
-            if key not in Q:
-                Q[key] = []
+        import tempfile
 
-            Q[key].append(next_cl)
+        fd, temporary_path = tempfile.mkstemp(
+                suffix='.npz',dir=os.path.dirname(cache_path)
+                )
+        try:
+            with os.fdopen(fd,'wb') as f:
+                np.savez(f,**{
+                    name: getattr(self,name) for name in _table_names
+                    if getattr(self,name) is not None
+                    })
+            os.replace(temporary_path,cache_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def _freeze(self):
+        """Build the tables of `step_batch()` and make all the tables read-only.
+
+        The tables are replaced by read-only views, so that arrays shared with
+        the caller (see `from_arrays()`) keep their flags.
+        """
+
+        def freeze(array):
+            if array is None:
+                return None
+            array = array.view()
+            array.flags.writeable = False
+            return array
+
+        for name in _table_names:
+            setattr(self,name,freeze(getattr(self,name)))
+        self._history_codes = freeze(self._history_codes)
+        self._history_order = freeze(self._history_order)
+        self._batch_tables = tuple(freeze(elt) for elt in self._get_batch_tables())
+
+    def _index_histories(self,history_codes=None,history_order=None):
+        """Lookup of the histories by code, and reset of the views as dicts.
+
+        The histories are found by a binary search in their sorted codes. The
+        sorted codes and the corresponding rows can be given (e.g., in shared
+        memory, see `attach()`), so that they are not recomputed.
+        """
+
+        self._exact_codes = self._codes_exact(self.L)
+        if self._exact_codes:
+            self._code_base = self.K+1
+        else:
+            self._code_base = _hash_base if self._force_hash is None else self._force_hash
+        if history_codes is None:
+            codes = row_codes(self.histories,self.K,self._exact_codes,self._force_hash)
+            history_order = np.argsort(codes,kind='stable')
+            history_codes = codes[history_order]
+            if np.any(history_codes[1:] == history_codes[:-1]):
+                raise Exception('Collision of the codes of two histories')
+        self._history_codes = history_codes
+        self._history_order = history_order
+        self._pruned = bool(np.any(self.histories[:,0] < 0))
+        self._Q = None
+        self._T = None
+
+    def _codes_exact(self,length):
+        """True if the sequences of `length` clusters have exact codes."""
+
+        return self._force_hash is None and exact_codes(self.K,length)
+
+    def _history_keys(self):
+        """Keys of the histories in Q and T."""
+
+        return [
+                ','.join(str(elt) for elt in h if elt >= 0)
+                for h in self.histories.tolist()
+                ]
+
+    def _prune(self,sequence,windows):
+        """Replace the rare pasts of the windows by their retained suffix.
+
+        A past padded with -1 has the code of its suffix, so the codes of all
+        the suffixes of length l are the codes of the windows of length l of
+        the sequence.
+
+        Returns
+        -------
+        contexts : ndarray of shape (n_contexts,L+1)
+            The windows, with pruned pasts padded with -1 on the left. A window
+            appears once for each retained past it ends with (its own one and
+            the suffixes retained for other windows), in the order of the data.
+        window_of_context : ndarray of shape (n_contexts,)
+            Index of the window of each context.
+        codes : ndarray of shape (n_contexts,)
+            Code of each context.
+        """
 
-            # update past_cl by removing the oldest element and adding next_cl
-            past_cl[:-1] = past_cl[1:]
-            past_cl[-1] = next_cl
+        L = self.L
+        K = self.K
+        n_windows = windows.shape[0]
+        force_hash = self._force_hash
+        exact = self._codes_exact(L+1)
+        exact_past = self._codes_exact(L)
+        if self.min_count <= 1:
+            return windows, np.arange(n_windows), \
+                    window_codes(sequence,L+1,K,exact,force_hash)
 
-        # Compute the probabilities
-        for k, possible_next in Q.items():
+        def suffix_codes(l):
+            # Code of the suffix of length l of the past of each window
+            return window_codes(sequence,l,K,exact_past,force_hash)[L-l:L-l+n_windows]
 
-            occurrences = np.bincount(possible_next) / len(possible_next)
-            probability = np.empty((0,2),dtype=int)
-            for elt in np.unique(possible_next):
-                probability = np.vstack((probability,[elt,occurrences[elt]]))
+        # Order of each window: the longest suffix of its past occurring at
+        # least min_count times (at least 1)
+        order = np.ones(n_windows,dtype=int)
+        undecided = np.ones(n_windows,dtype=bool)
+        for l in range(L,1,-1):
+            _, _, inverse, counts = _unique_rows(
+                    windows[:,L-l:L],suffix_codes(l),exact_past
+                    )
+            retained = undecided & (counts[inverse] >= self.min_count)
+            order[retained] = l
+            undecided &= ~retained
 
-            # Re-write the values with the probabilities
-            Q[k] = probability
+        # Each window contributes to all the retained pasts it ends with. All
+        # the current centroids are retained, so that any past backs off.
+        contexts, window_of_context, codes = [], [], []
+        for l in np.union1d(order,[1]):
+            past_codes = suffix_codes(l)
+            selected = (order == l) | (l == 1)
+            retained, first = np.unique(past_codes[selected],return_index=True)
+            first = np.flatnonzero(selected)[first]
+            padded = np.array(windows)
+            padded[:,:L-l] = -1
+            match = np.flatnonzero(_lookup_codes(
+                padded[first,:L],retained,np.arange(retained.size),
+                padded[:,:L],past_codes,exact_past,
+                ) >= 0)
+            contexts.append(padded[match])
+            window_of_context.append(match)
+            codes.append(window_codes(sequence[L-l:],l+1,K,exact,force_hash)[match])
+        contexts = np.concatenate(contexts)
+        window_of_context = np.concatenate(window_of_context)
+        codes = np.concatenate(codes)
 
-        return Q
+        order = np.argsort(window_of_context,kind='stable')
+
+        return contexts[order], window_of_context[order], codes[order]
 
     def _compute_T(self):
         """Compute the transition time"""
 
         # Number of steps in each sequentially visited cluster
-        n_steps_in_cl = np.array([sum(1 for i in g) for k,g in groupby(self.labels)])
+        n_steps_in_cl = self.run_lengths
+
+        # Transition time of each window (current, next and all pasts): half
+        # of the time in the current and next clusters
+        n_windows = self._windows.shape[0]
+        transition_time = (
+                n_steps_in_cl[self.L-1:self.L-1+n_windows]
+                + n_steps_in_cl[self.L:self.L+n_windows]
+                )/2. * self.dt
+
+        # Histograms with common bins
+        self.time_bin_edges = None
+        if self.time_bins is not None:
+            self.time_bin_edges = np.linspace(
+                    transition_time.min(),transition_time.max(),self.time_bins+1
+                    ).astype(self.dtype)
+
+        # Statistics of the transition times of the same sequence of
+        # centroids
+        (
+                self.transition_counts,
+                self.transition_times,
+                self.transition_time_m2,
+                self.time_histograms,
+                ) = self._time_statistics(
+                        self._transition_of_context,
+                        transition_time[self._window_of_context],
+                        self.destinations.size,
+                        )
+
+        if self.smoothing > 0:
+            self._smooth(transition_time)
+
+        del self._transition_of_context, self._window_of_context, self._windows
+
+        print('Average transition time: {}'.format(round(np.mean(self.transition_times),3)))
+
+    def _time_statistics(self,groups,transition_time,n_groups):
+        """Count, mean, sum of the squared deviations and histogram of the
+        transition times of each group, summed in the order of the data."""
+
+        order = np.argsort(groups,kind='stable')
+        counts = np.bincount(groups,minlength=n_groups)
+        starts = np.concatenate(([0],np.cumsum(counts)[:-1]))
+        sorted_time = transition_time[order]
+        mean = np.add.reduceat(sorted_time,starts) / counts
+        m2 = np.add.reduceat((sorted_time - np.repeat(mean,counts))**2,starts)
+
+        histograms = None
+        if self.time_bin_edges is not None:
+            bins = np.clip(
+                    np.searchsorted(self.time_bin_edges,transition_time,side='right') - 1,
+                    0,self.time_bins-1
+                    )
+            histograms = np.bincount(
+                    groups * self.time_bins + bins,
+                    minlength=n_groups * self.time_bins,
+                    ).reshape(-1,self.time_bins).astype(np.int32)
+
+        return (
+                counts.astype(np.int32),
+                mean.astype(self.dtype),
+                m2.astype(self.dtype),
+                histograms,
+                )
+
+    def _smooth(self,transition_time):
+        """Dirichlet smoothing of the probabilities, see `smoothing`."""
+
+        K = self.K
+        L = self.L
+
+        # First-order transitions (current and next centroid) of all windows
+        pairs = self._windows[:,L-1].astype(np.int64) * K + self._windows[:,L]
+        first_order, inverse = np.unique(pairs,return_inverse=True)
+        first_counts, first_times, first_m2, first_histograms = \
+                self._time_statistics(
+                        inverse.reshape(-1),transition_time,first_order.size
+                        )
+        first_from = first_order // K
+        first_probabilities = first_counts / np.bincount(
+                first_from,weights=first_counts,minlength=K
+                )[first_from]
+
+        # Candidate transitions: the observed ones, then the first-order
+        # destinations of the current centroid of each history
+        n_transitions = self.destinations.size
+        history_of_transition = np.repeat(
+                np.arange(self.n_histories),np.diff(self.indptr)
+                )
+        first_indptr = np.searchsorted(first_from,np.arange(K+1))
+        current = self.histories[:,-1].astype(int)
+        n_added = first_indptr[current+1] - first_indptr[current]
+        history_of_added = np.repeat(np.arange(self.n_histories),n_added)
+        first_of_added = np.arange(n_added.sum()) \
+                - np.repeat(np.cumsum(n_added) - n_added,n_added) \
+                + np.repeat(first_indptr[current],n_added)
+
+        rows = np.concatenate((history_of_transition,history_of_added))
+        destinations = np.concatenate((
+            self.destinations,(first_order[first_of_added] % K).astype(self.destinations.dtype)
+            ))
+
+        # Sorted by history and destination, keeping the observed transitions
+        _, index = np.unique(rows * K + destinations,return_index=True)
+        observed = index < n_transitions
+        i_observed = index[observed]
+        i_first = first_of_added[index[~observed] - n_transitions]
+
+        counts = np.zeros(index.size)
+        counts[observed] = self.transition_counts[i_observed]
+        history_counts = np.bincount(
+                history_of_transition,weights=self.transition_counts,
+                minlength=self.n_histories,
+                )
+        rows = rows[index]
+        destinations = destinations[index]
+        prior = first_probabilities[np.searchsorted(
+            first_order,self.histories[rows,-1].astype(np.int64) * K + destinations
+            )]
+        self.probabilities = (
+                (counts + self.smoothing * prior)
+                / (history_counts[rows] + self.smoothing)
+                ).astype(self.dtype)
+
+        def merge(table,first_table):
+            merged = np.empty((index.size,)+table.shape[1:],dtype=table.dtype)
+            merged[observed] = table[i_observed]
+            merged[~observed] = first_table[i_first]
+            return merged
+
+        self.transition_counts = merge(self.transition_counts,first_counts)
+        self.transition_times = merge(self.transition_times,first_times)
+        self.transition_time_m2 = merge(self.transition_time_m2,first_m2)
+        if self.time_histograms is not None:
+            self.time_histograms = merge(self.time_histograms,first_histograms)
+        self.destinations = destinations
+        self.indptr = np.searchsorted(rows,np.arange(self.n_histories+1))
 
-        T = {}
+        self._index_histories()
+        self._batch_tables = None
 
-        # Loop over
-        for i_cl in range(self.cluster_sequence.size-(self.L+1)): # Last transition is neglected
 
-            # Sequential chunks of length self.L+1 (current, next and all pasts)
-            cluster_sequence_loc = self.cluster_sequence[i_cl:i_cl+self.L+1]
+# Tables of the model, see `to_arrays()`
+_table_names = (
+        'histories','indptr','destinations','probabilities','transition_times',
+        'transition_counts','transition_time_m2','time_bin_edges',
+        'time_histograms',
+        )
 
-            transition_time = np.sum(
-                    n_steps_in_cl[i_cl+self.L-1:i_cl+self.L+1]
-                    )/2. * self.dt
+# Base of the hashed codes, odd so that it is invertible modulo 2**64
+_hash_base = 0x9E3779B97F4A7C15
+_code_mask = 2**64 - 1
 
-            key = ','.join(map(str, cluster_sequence_loc))
+def exact_codes(K,length):
+    """True if the sequences of `length` clusters have exact codes."""
 
-            # Make sure the key exists (and the value is a list)
-            if key not in T:
-                T[key] = []
-            T[key].append(transition_time)
+    return (K+1)**length <= 2**64
 
-        # Average the transition times of the same sequence of centroids
-        total_times = []
-        for k, transition_times in T.items():
-            T[k] = np.mean(transition_times)
-            total_times.append(T[k])
+def row_codes(rows,K,exact=None,_force_hash=None):
+    """Code of each row of clusters.
 
-        print('Average transition time: {}'.format(round(np.mean(total_times),3)))
+    The code is the number with the digits c+1 (so that the padding -1 is 0)
+    in base K+1 if it fits in 64 bits, else a polynomial hash modulo 2**64.
+    The rows are processed column by column.
 
-        return T
+    Parameters
+    ----------
+    rows : ndarray of shape (n,length)
+        Rows of cluster indices, possibly padded with -1 on the left.
+    K : int
+        Number of clusters.
+    exact : bool, optional
+        Use the exact codes. Defaults to `exact_codes(K,length)`.
+    _force_hash : int, optional
+        Odd base of hashed codes, used whatever `exact`. Only for testing the
+        hashed codes and their collisions.
+
+    Returns
+    -------
+    codes : ndarray of shape (n,)
+        Code of each row, as uint64.
+    """
+
+    rows = np.asarray(rows)
+    if _force_hash is not None:
+        exact, base = False, np.uint64(_force_hash)
+    else:
+        if exact is None:
+            exact = exact_codes(K,rows.shape[-1])
+        base = np.uint64(K+1 if exact else _hash_base)
+
+    codes = np.zeros(rows.shape[:-1],dtype=np.uint64)
+    for i in range(rows.shape[-1]):
+        codes = codes * base + (rows[...,i].astype(np.int64) + 1).astype(np.uint64)
+
+    return codes
+
+def window_codes(sequence,length,K,exact=None,_force_hash=None):
+    """Code of every window of `length` consecutive clusters of a sequence.
+
+    The codes equal those of `row_codes()` for the rows of
+    np.lib.stride_tricks.sliding_window_view(sequence,length). The hashed
+    codes are computed in O(n), whatever the length, as differences of a
+    prefix sum of the digits times the inverse powers of the base.
+
+    Parameters
+    ----------
+    sequence : ndarray of shape (n,)
+        Sequence of cluster indices.
+    length : int
+        Length of the windows.
+    K, exact, _force_hash :
+        See `row_codes()`.
+
+    Returns
+    -------
+    codes : ndarray of shape (n-length+1,)
+        Code of each window, as uint64.
+    """
+
+    sequence = np.asarray(sequence)
+    if _force_hash is not None:
+        exact, base = False, _force_hash
+    else:
+        if exact is None:
+            exact = exact_codes(K,length)
+        base = _hash_base
+    if sequence.size < length:
+        return np.zeros(0,dtype=np.uint64)
+
+    if exact:
+        return row_codes(
+                np.lib.stride_tricks.sliding_window_view(sequence,length),K,True
+                )
+
+    # Arithmetic modulo 2**64 with the wrap-around of uint64
+    digits = (sequence.astype(np.int64) + 1).astype(np.uint64)
+    powers = np.ones(sequence.size,dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(sequence.size-1,base,dtype=np.uint64))
+    inverse_powers = np.ones(sequence.size,dtype=np.uint64)
+    inverse_powers[1:] = np.cumprod(np.full(
+        sequence.size-1,pow(base,-1,2**64),dtype=np.uint64
+        ))
+    prefix = np.zeros(sequence.size+1,dtype=np.uint64)
+    np.cumsum(digits * inverse_powers,out=prefix[1:])
+
+    return (prefix[length:] - prefix[:-length]) * powers[length-1:]
+
+def _unique_rows(rows,codes,exact):
+    """np.unique(rows,axis=0) with its index, inverse and counts, from the
+    codes of the rows.
+
+    The unique rows are sorted as with np.unique. Hashed codes are checked for
+    collisions, in which case the rows themselves are compared.
+    """
+
+    _, first, inverse, counts = np.unique(
+            codes,return_index=True,return_inverse=True,return_counts=True
+            )
+    inverse = inverse.reshape(-1)
+    unique = rows[first]
+
+    if not exact:
+        if not np.array_equal(unique[inverse],rows):
+            unique, first, inverse, counts = np.unique(
+                    rows,axis=0,return_index=True,return_inverse=True,
+                    return_counts=True,
+                    )
+            return unique, first, inverse.reshape(-1), counts
+
+        # Lexicographic order of the rows, as for the exact codes
+        order = np.lexsort(unique.T[::-1])
+        rank = np.empty_like(order)
+        rank[order] = np.arange(order.size)
+        unique, first, counts, inverse = \
+                unique[order], first[order], counts[order], rank[inverse]
+
+    return unique, first, inverse, counts
+
+def _lookup_codes(reference,sorted_codes,order,query,query_codes,exact):
+    """Row of each query row in `reference` (with unique rows), or -1.
+
+    The rows are matched by their codes: `sorted_codes` are the sorted codes
+    of the reference rows, and `order` the rows in that order. Hashed codes
+    are checked for collisions by comparing the rows.
+    """
+
+    if sorted_codes.size == 0:
+        return np.full(query_codes.shape,-1)
+
+    position = np.minimum(
+            np.searchsorted(sorted_codes,query_codes),sorted_codes.size-1
+            )
+    rows = order[position]
+    found = sorted_codes[position] == query_codes
+    if not exact:
+        found &= np.all(reference[rows] == query,axis=1)
+
+    return np.where(found,rows,-1)
+
+def _resource_tracker_id():
+    """Inode of the pipe to the resource tracker of this process, which is
+    shared with its child processes. None without resource tracker."""
+
+    if os.name != 'posix':
+        return None
+
+    from multiprocessing import resource_tracker
+
+    resource_tracker.ensure_running()
+    return os.fstat(resource_tracker._resource_tracker._fd).st_ino
+
+def _id_dtype(K):
+    """Smallest integer type holding the cluster indices."""
+
+    if K <= np.iinfo(np.int16).max:
+        return np.int16
+    return np.int32
 
 if __name__=='__main__':
 
+    from itertools import groupby
     from sklearn.cluster import KMeans
     np.random.seed(0)
 
@@ -306,5 +1562,223 @@ if __name__=='__main__':
     # check if the keys of T are correct
     assert transition_properties.T.keys() == T_test.keys()
 
-    # check if T is correct
-    assert transition_properties.T == T_test
+    # check if T is correct (the averages are summed in a different order
+    # than np.mean, which may change the last digit)
+    for k in T_test.keys():
+        np.testing.assert_allclose(transition_properties.T[k], T_test[k], rtol=1e-12, atol=0)
+
+    # transition time statistics
+    transition_properties = TransitionProperties(**transition_config,time_bins=20)
+    windows = np.lib.stride_tricks.sliding_window_view(
+            clustering.cluster_sequence[:-1],L+1)
+    n_steps = np.array([len(list(g)) for k, g in groupby(clustering.labels)])
+    times = (n_steps[L-1:-1] + n_steps[L:]) / 2. * dt
+    for i in [0,5,10]:
+        i_history = np.searchsorted(transition_properties.indptr,i,side='right') - 1
+        key = transition_properties.histories[i_history].tolist() + [transition_properties.destinations[i]]
+        times_i = times[:windows.shape[0]][np.all(windows == key,axis=1)]
+        assert transition_properties.transition_counts[i] == times_i.size
+        np.testing.assert_allclose(transition_properties.transition_time_var[i],np.var(times_i),atol=1e-12)
+        assert transition_properties.time_histograms[i].sum() == times_i.size
+        assert times_i.min() - 1e-12 <= transition_properties.transition_time_quantile(0.5)[i] <= times_i.max() + 1e-12
+
+    # sampled transition times stay within the observed range
+    i_transitions = np.random.randint(transition_properties.destinations.size,size=1000)
+    sampled = transition_properties.sample_transition_times(i_transitions)
+    assert np.all(sampled >= transition_properties.time_bin_edges[0])
+    assert np.all(sampled <= transition_properties.time_bin_edges[-1])
+    transition_properties.time_histograms = None
+    sampled = transition_properties.sample_transition_times(i_transitions)
+    assert np.all(sampled > 0)
+
+    # score of the data of the model: all the transitions are known, and the
+    # time error is the spread of the transition times
+    transition_properties = TransitionProperties(**transition_config)
+    scores = transition_properties.score(clustering.cluster_sequence,clustering.run_lengths)
+    assert scores['n_known'] == scores['n_found'] == scores['n_transitions'] == windows.shape[0]
+    np.testing.assert_allclose(scores['log_likelihood'],np.sum(
+        transition_properties.transition_counts*np.log(transition_properties.probabilities)))
+    np.testing.assert_allclose(scores['time_rmse'],np.sqrt(
+        transition_properties.transition_time_m2.sum() / windows.shape[0]))
+    assert scores['perplexity'] >= 1
+
+    # batched scores of parts of the sequence
+    sequences = [clustering.cluster_sequence[:300],clustering.cluster_sequence[300:]]
+    batch_scores = transition_properties.score_batch(sequences)
+    for sequence, log_likelihood in zip(sequences,batch_scores['log_likelihood']):
+        assert log_likelihood == transition_properties.score(sequence)['log_likelihood']
+    assert np.all(np.isnan(batch_scores['time_rmse']))
+
+    # unknown pasts are skipped, unknown transitions have a zero probability
+    past = transition_properties.histories[0]
+    unseen = np.setdiff1d(np.arange(K),transition_properties.transitions(past)[1])[0]
+    scores = transition_properties.score(np.append(past,[unseen,0]))
+    assert scores['n_known'] == 1 and scores['n_found'] == 0
+    assert scores['log_likelihood'] == -np.inf
+    scores = transition_properties.score(np.array([0,0,0,0,0]))
+    assert scores['n_transitions'] == 1 and scores['n_known'] == 0
+    assert scores['log_likelihood'] == 0
+
+    # compact storage
+    transition_properties = TransitionProperties(**transition_config,dtype=np.float32)
+    assert transition_properties.destinations.dtype == np.int16
+    assert transition_properties.probabilities.dtype == np.float32
+    assert transition_properties.transition_times.dtype == np.float32
+    for k in Q_test.keys():
+        np.testing.assert_allclose(transition_properties.Q[k], Q_test[k], rtol=1e-2, atol=0)
+    for k in T_test.keys():
+        np.testing.assert_allclose(transition_properties.T[k], T_test[k], rtol=1e-6, atol=0)
+
+    # pruning of the rare histories, with back-off to their suffixes
+    L_long = 15
+    full = TransitionProperties(clustering,K,L_long,dt)
+    pruned = TransitionProperties(clustering,K,L_long,dt,min_count=5)
+    assert pruned.n_histories < full.n_histories
+    assert pruned.nbytes < full.nbytes
+    history_counts = np.add.reduceat(pruned.transition_counts,pruned.indptr[:-1])
+    full_order = pruned.histories[:,0] >= 0
+    assert np.all(history_counts[full_order] >= 5)
+    np.testing.assert_allclose(np.add.reduceat(pruned.probabilities,pruned.indptr[:-1]),1)
+    rare = full.histories[np.add.reduceat(full.transition_counts,full.indptr[:-1]) < 5][0]
+    past_cl, i_history = pruned._find_history(rare.astype(int))
+    assert past_cl[0] == -1 and np.all(past_cl[past_cl >= 0] == rare[past_cl >= 0])
+    next_history, _, _ = pruned.step_batch(np.arange(pruned.n_histories),np.random.default_rng(0))
+    assert np.all(next_history >= 0)
+    scores = pruned.score(clustering.cluster_sequence)
+    assert scores['n_found'] == scores['n_transitions']
+
+    # smoothing towards the first-order model
+    smoothed = TransitionProperties(clustering,K,L_long,dt,smoothing=1.)
+    assert smoothed.destinations.size > full.destinations.size
+    np.testing.assert_allclose(np.add.reduceat(smoothed.probabilities,smoothed.indptr[:-1]),1)
+    first_order = TransitionProperties(clustering,K,1,dt)
+    smoothed = TransitionProperties(clustering,K,L_long,dt,smoothing=1e12)
+    for i_history in range(0,smoothed.n_histories,10):
+        _, destinations, probabilities, _ = smoothed.transitions(smoothed.histories[i_history])
+        _, destinations_1, probabilities_1, _ = first_order.transitions(smoothed.histories[i_history,-1:])
+        assert np.all(destinations == destinations_1)
+        # the first-order model also counts the first L-1 transitions
+        np.testing.assert_allclose(probabilities,probabilities_1,atol=1e-2)
+
+    # codes of the windows, exact and hashed
+    sequence = clustering.cluster_sequence
+    for length in [1,4,30]:
+        rows = np.lib.stride_tricks.sliding_window_view(sequence,length)
+        for exact in [None,False]:
+            assert np.all(window_codes(sequence,length,K,exact) == row_codes(rows,K,exact))
+    codes = row_codes(rows[:,:4],K)
+    order = np.lexsort(rows[:,:4].T[::-1])
+    assert np.all(np.diff(codes[order].astype(float)) >= 0)
+
+    # hashed codes give the same model as the exact ones
+    exact_model = TransitionProperties(clustering,K,8,dt,min_count=20)
+    hashed_model = TransitionProperties(
+            clustering,K,8,dt,min_count=20,_force_hash=_hash_base
+            )
+    assert hashed_model._pruned and not hashed_model._exact_codes
+    assert exact_model._exact_codes
+    for name in _table_names[:5]:
+        assert np.all(getattr(hashed_model,name) == getattr(exact_model,name))
+    assert np.all(hashed_model._get_batch_tables()[1] == exact_model._get_batch_tables()[1])
+
+    for length in [1,4,30]:
+        rows = np.lib.stride_tricks.sliding_window_view(sequence,length)
+        assert np.all(window_codes(sequence,length,K,True,3) == row_codes(rows,K,True,3))
+
+    # collisions are detected
+    hashed_rows = rows[:,:3]
+    unique = _unique_rows(hashed_rows,row_codes(hashed_rows,K,_force_hash=1),False)
+    expected = np.unique(hashed_rows,axis=0,return_index=True,return_inverse=True,return_counts=True)
+    for elt, elt_expected in zip(unique,expected):
+        assert np.all(elt == elt_expected.reshape(elt.shape))
+    try:
+        TransitionProperties(**transition_config,_force_hash=1)
+        detected = False
+    except Exception as e:
+        detected = 'Collision' in str(e)
+    assert detected
+
+    # model rebuilt from its arrays, and shared between processes
+    from concurrent.futures import ProcessPoolExecutor
+    transition_properties = TransitionProperties(**transition_config,time_bins=20)
+    rebuilt = TransitionProperties.from_arrays(transition_properties.to_arrays(),L,dt)
+    assert rebuilt.Q.keys() == transition_properties.Q.keys()
+    assert rebuilt.score(clustering.cluster_sequence)['log_likelihood'] == \
+            transition_properties.score(clustering.cluster_sequence)['log_likelihood']
+
+    def propagate_shared(seed):
+        i_histories = np.arange(shared_model.histories.shape[0])
+        return shared_model.step_batch(i_histories,np.random.default_rng(seed),True)
+
+    def attach_shared(spec):
+        global shared_model
+        shared_model = TransitionProperties.attach(spec)
+
+    shared, spec = transition_properties.share()
+    try:
+        with ProcessPoolExecutor(2,initializer=attach_shared,initargs=(spec,)) as pool:
+            results = list(pool.map(propagate_shared,range(4)))
+        attach_shared(spec)
+        assert not shared_model.probabilities.flags.writeable
+        assert shared_model.time_bins == 20
+
+        # the histories are looked up in the shared sorted codes
+        assert 'history_codes' in dict((elt[0],elt) for elt in spec['layout'])
+        assert not shared_model._history_codes.flags.writeable
+        for i_history, history in enumerate(shared_model.histories):
+            assert shared_model._find_row(history) == i_history
+        assert shared_model._find_row([K+1]*L) is None
+        for seed, result in enumerate(results):
+            expected = transition_properties.step_batch(
+                    np.arange(transition_properties.histories.shape[0]),
+                    np.random.default_rng(seed),True,
+                    )
+            for elt, elt_expected in zip(result,expected):
+                assert np.all(elt == elt_expected)
+        del shared_model
+
+        # attached by a process that is not a child of the owner, which does
+        # not unlink the block at exit
+        import subprocess
+        import sys
+        attached = subprocess.run(
+                [sys.executable,'-c','import sys; '
+                 'from transition_properties import TransitionProperties; '
+                 'model = TransitionProperties.attach(eval(sys.stdin.read())); '
+                 'print(model.transition_counts.sum())'],
+                input=repr(spec),capture_output=True,text=True,check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                )
+        assert int(attached.stdout) == transition_properties.transition_counts.sum()
+        assert 'leaked' not in attached.stderr, attached.stderr
+        attach_shared(spec)
+        assert np.all(shared_model.probabilities == transition_properties.probabilities)
+        del shared_model
+    finally:
+        shared.close()
+        shared.unlink()
+
+    # cached model, read instead of computed for the same clustering and
+    # parameters
+    import contextlib
+    import io
+    cache_path = TransitionProperties(**transition_config,time_bins=20)._cache_path()
+    other_cache_path = TransitionProperties(**transition_config)._cache_path()
+    try:
+        computed = TransitionProperties(**transition_config,time_bins=20,cache=True)
+        assert os.path.exists(cache_path)
+        assert not [name for name in os.listdir(os.path.dirname(cache_path))
+                    if name.startswith('tmp')]
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cached = TransitionProperties(**transition_config,time_bins=20,cache=True)
+        assert 'Read from {}'.format(cache_path) in output.getvalue()
+        for name in _table_names:
+            assert np.all(getattr(cached,name) == getattr(computed,name))
+        assert cached.Q.keys() == computed.Q.keys()
+        assert cached.cluster_sequence is clustering.cluster_sequence
+        assert TransitionProperties(**transition_config,cache=True)._cache_path() != cache_path
+    finally:
+        for path in [cache_path,other_cache_path]:
+            if os.path.exists(path):
+                os.remove(path)
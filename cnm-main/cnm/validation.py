@@ -0,0 +1,206 @@
+#
+# Copyright (c) 2020 Daniel Fernex.
+# Copyright (c) 2020 Bernd R. Noack.
+# Copyright (c) 2020 Richard Semaan.
+#
+# This file is part of CNM
+# (see https://github.com/fernexda/cnm).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Cross-validation of CNM models on held-out parts of the data."""
+
+import numpy as np
+import os
+
+
+def cross_validate(data,cluster_algo,dataset,L,dt,n_folds=5,n_jobs=None):
+    """Measure the predictive skill of CNM on held-out folds.
+
+    The data is split into `n_folds` folds. For each fold, a model (Clustering
+    and TransitionProperties) is fitted on the other folds, the held-out
+    snapshots are assigned to its centroids, and the resulting cluster
+    sequence is scored under the model.
+
+    Parameters
+    ----------
+    data : ndarray of shape (n_snapshots,n_dim) or list of ndarrays
+        Snapshots, equally spaced in time. A single time series is split into
+        contiguous segments; a list of trajectories is split into groups of
+        consecutive trajectories. The training data of a fold is concatenated,
+        which adds a spurious transition at each junction.
+    cluster_algo : object
+        Instance from the selected clustering class, see `Clustering`. A copy
+        is fitted for each fold.
+    dataset : str
+        A label defining the dataset. The clustering of fold i is cached in
+        'output/<dataset>/cv<n_folds>-fold<i>-<hash>', where the hash covers
+        the training data of the fold and the parameters of `cluster_algo`,
+        so that it is only reused by validations on the same data.
+    L : int
+        CNM model order.
+    dt : float
+        Time step of the data.
+    n_folds : int, optional
+        Number of folds.
+    n_jobs : int, optional
+        Number of processes evaluating the folds. -1 uses all the cores.
+
+    Returns
+    -------
+    scores : dict of ndarrays of shape (n_folds,)
+        'log_likelihood': average log-likelihood per transition of the
+        held-out cluster sequence, over the transitions whose past is in the
+        model. 'coverage': fraction of the held-out transitions whose past is
+        in the model. 'time_rmse': root mean square error of the transition
+        times, over the held-out transitions found in the model.
+    """
+
+    folds = _split(data,n_folds)
+
+    arguments = [
+            (i_fold,cluster_algo,'{}/cv{}-fold{}'.format(dataset,n_folds,i_fold),L,dt)
+            for i_fold in range(n_folds)
+            ]
+
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs == 1:
+        _set_folds(folds)
+        results = [_evaluate_fold(*elt) for elt in arguments]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(
+                min(n_jobs,n_folds),initializer=_set_folds,initargs=(folds,)
+                ) as pool:
+            results = list(pool.map(_evaluate_fold,*zip(*arguments)))
+
+    return {
+            key: np.array([result[key] for result in results])
+            for key in results[0]
+            }
+
+
+def _split(data,n_folds):
+    """Split the data into folds, each a list of trajectories."""
+
+    if isinstance(data,(list,tuple)):
+        if len(data) < n_folds:
+            raise ValueError('{} trajectories cannot be split into {} folds'.format(
+                len(data),n_folds))
+        bounds = np.linspace(0,len(data),n_folds+1).astype(int)
+        return [list(data[start:stop]) for start, stop in zip(bounds[:-1],bounds[1:])]
+
+    return [[fold] for fold in np.array_split(data,n_folds)]
+
+# Folds of the data, set in each process
+_folds = None
+
+def _set_folds(folds):
+    global _folds
+    _folds = folds
+
+def _evaluate_fold(i_fold,cluster_algo,dataset,L,dt):
+    """Fit the model on all folds but i_fold and score it on i_fold."""
+
+    import hashlib
+    from sklearn.base import clone
+    Clustering, run_length_encode, TransitionProperties = _import_model()
+
+    training_data = np.concatenate([
+        trajectory
+        for j_fold, fold in enumerate(_folds) if j_fold != i_fold
+        for trajectory in fold
+        ])
+
+    # The cached clustering is specific to the training data
+    digest = hashlib.sha1(repr((
+        training_data.shape,training_data.dtype.str,
+        sorted(cluster_algo.get_params().items()),
+        )).encode())
+    digest.update(memoryview(np.ascontiguousarray(training_data)).cast('B'))
+    dataset = '{}-{}'.format(dataset,digest.hexdigest()[:16])
+
+    clustering = Clustering(training_data,clone(cluster_algo),dataset)
+    transition_properties = TransitionProperties(
+            clustering,clustering.centroids.shape[0],L,dt
+            )
+
+    # Score the held-out trajectories
+    cluster_sequences, run_lengths = [], []
+    for trajectory in _folds[i_fold]:
+        cluster_sequence, n_steps = run_length_encode(clustering.assign(trajectory))
+        cluster_sequences.append(cluster_sequence)
+        run_lengths.append(n_steps)
+
+    scores = transition_properties.score_batch(cluster_sequences,run_lengths)
+    n_known = scores['n_known'].sum()
+    n_found = scores['n_found'].sum()
+    squared_time_error = np.nansum(scores['time_rmse']**2 * scores['n_found'])
+
+    return {
+            'log_likelihood': scores['log_likelihood'].sum() / max(n_known,1),
+            'coverage': n_known / max(scores['n_transitions'].sum(),1),
+            'time_rmse': np.sqrt(squared_time_error / max(n_found,1)),
+            }
+
+def _import_model():
+    """The classes of the model, imported at first use from the package, or
+    from the folder of this file when it runs as a script."""
+
+    try:
+        from .clustering import Clustering, run_length_encode
+        from .transition_properties import TransitionProperties
+    except ImportError:
+        from clustering import Clustering, run_length_encode
+        from transition_properties import TransitionProperties
+
+    return Clustering, run_length_encode, TransitionProperties
+
+
+if __name__=='__main__':
+
+    import glob
+    import shutil
+    from sklearn.cluster import KMeans
+
+    test_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),'test_data')
+    data = np.load(os.path.join(test_dir,'data.npy'))
+    dt = 0.016666944449074152
+    K, L = 5, 2
+
+    try:
+        cluster_algo = KMeans(n_clusters=K,max_iter=300,n_init=10,random_state=0)
+        scores = cross_validate(data,cluster_algo,'dummy',L,dt,n_folds=3,n_jobs=3)
+        assert scores['log_likelihood'].shape == (3,)
+        assert np.all(scores['log_likelihood'] <= 0)
+        assert np.all((scores['coverage'] > 0.9) & (scores['coverage'] <= 1))
+
+        # The folds are evaluated the same way in series and in parallel
+        scores_serial = cross_validate(data,cluster_algo,'dummy',L,dt,n_folds=3)
+        for key in scores:
+            np.testing.assert_allclose(scores[key],scores_serial[key])
+        assert len(glob.glob('output/dummy/cv3-fold*')) == 3
+
+        # A list of trajectories
+        scores = cross_validate(np.array_split(data,6),cluster_algo,'dummy',L,dt,n_folds=3)
+        assert np.all(np.isfinite(scores['time_rmse']))
+
+        # Other data does not reuse the cached clusterings
+        cross_validate(data[::-1],cluster_algo,'dummy',L,dt,n_folds=3)
+        assert len(glob.glob('output/dummy/cv3-fold*')) == 6
+    finally:
+        for folder in glob.glob('output/dummy/cv3-fold*'):
+            shutil.rmtree(folder)
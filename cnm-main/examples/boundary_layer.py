@@ -57,6 +57,7 @@ def run_boundary_layer():
             'dt': dt,
             'K': K,
             'L': L,
+            'cache': True,
             }
 
     transition_properties = TransitionProperties(**transition_config)
@@ -90,7 +91,7 @@ def run_boundary_layer():
     plot_time_series(t,data,t_hat,x_hat,time_range,plot_label,n_dim=n_dim)
 
     # cluster probability distribution
-    plot_cpd(data,x_hat)
+    plot_cpd(clustering,propagation)
 
     # autocorrelation function
     time_blocks = t_hat[-1]
@@ -66,6 +66,7 @@ def run_ecg():
             'dt': dt,
             'K': K,
             'L': L,
+            'cache': True,
             }
 
     transition_properties = TransitionProperties(**transition_config)
@@ -99,7 +100,7 @@ def run_ecg():
     plot_time_series(t,data,t_hat,x_hat,time_range,plot_label,n_dim)
 
     # cluster probability distribution
-    plot_cpd(data,x_hat)
+    plot_cpd(clustering,propagation)
 
     # autocorrelation function
     time_blocks = 40
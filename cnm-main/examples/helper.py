@@ -22,13 +22,7 @@
 #
 
 import numpy as np
-from mpl_toolkits.mplot3d import Axes3D
-import numpy as np
-import matplotlib.pyplot as plt
 import os
-from matplotlib import cm
-from scipy.integrate import solve_ivp
-from scipy.interpolate import InterpolatedUnivariateSpline
 
 # Plotting parameters
 # ------------------------------------------------------------------------------
@@ -37,8 +31,6 @@ params = {
         'font.family': 'serif',
          }
 
-plt.rcParams.update(params)
-
 #FIGSIZE1 = (6,5)
 #FIGSIZE2 = (6,4)
 LW = 2          # line with
@@ -46,6 +38,18 @@ LFONTSIZE = 18  # label font size
 TFONTSIZE = 15  # tick font size
 # ------------------------------------------------------------------------------
 
+def _pyplot():
+    """Import matplotlib at first use and apply the plotting parameters.
+
+    matplotlib is only needed for plotting, so it is not imported with the
+    module.
+    """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers the 3d projection
+
+    plt.rcParams.update(params)
+    return plt
+
 def plot_phase_space(data,centroids,labels,n_dim=3):
     """Plot the phase space with the snapshots trajectory and the centroids"""
     
@@ -64,6 +68,9 @@ def plot_phase_space(data,centroids,labels,n_dim=3):
 def plot_phase_space_2d(n_cl,data,centroids,labels):
     """Plot the phase space in 2d"""
 
+    plt = _pyplot()
+    from matplotlib import cm
+
     plt.close()
     fig = plt.figure(figsize=(6,5))
     ax = fig.add_subplot(111)
@@ -118,6 +125,9 @@ def plot_phase_space_2d(n_cl,data,centroids,labels):
 def plot_phase_space_3d(n_cl,data,centroids,labels):
     """Plot the phase space in 3d"""
 
+    plt = _pyplot()
+    from matplotlib import cm
+
     plt.close()
     fig = plt.figure(figsize=(6,5))
     ax = fig.add_subplot(111,projection='3d')
@@ -181,6 +191,7 @@ def smooth_data(data):
     data_smooth = np.empty((t_smooth.size,data.shape[1]))
 
     # Interpolate
+    from scipy.interpolate import InterpolatedUnivariateSpline
     for i_dim in range(data.shape[1]):
         spline = InterpolatedUnivariateSpline(t, data[:,i_dim])
 
@@ -195,6 +206,8 @@ def plot_time_series(t,x,t_hat,x_hat,time_range,plot_label,n_dim=3):
     print('Plot time series')
     print('----------------\n')
 
+    plt = _pyplot()
+
     # Truncate at the same length
     size = min(t.size,t_hat.size)
     t = t[:size]
@@ -312,25 +325,35 @@ def plot_time_series(t,x,t_hat,x_hat,time_range,plot_label,n_dim=3):
     plt.show()
 
 
-def plot_cpd(x,x_hat):
-    """Plot the cluster probability vector"""
+def plot_cpd(clustering,propagation,K=10):
+    """Plot the cluster probability vector
+
+    The distributions are computed from the labels of the clustering and the
+    centroids visited by the propagation. For clarity, the clusters are
+    grouped into K coarse clusters.
+    """
 
     print('Plot cluster probability distribution')
     print('-------------------------------------\n')
 
-    # Re-cluster original and CNM data with 10 clusters only for clarity
-    from sklearn.cluster import KMeans
-    K = 10
-    kmeans = KMeans(n_clusters=K,max_iter=300,n_init=10)
-    kmeans.fit(x)
-    labels = kmeans.labels_
+    plt = _pyplot()
+
+    from cnm.analysis import (cluster_probability, visit_probability,
+                              coarse_graining_map)
 
-    # Predict cluster affiliation of the CNM data
-    labels_hat = kmeans.predict(x_hat)
+    # Group the centroids in K coarse clusters, weighted by their probability
+    centroids = clustering.centroids
+    K = min(K,centroids.shape[0])
+    q_fine = cluster_probability(clustering.labels,centroids.shape[0])
+    coarse_map = coarse_graining_map(centroids,K,weights=q_fine)
 
     # Probability distribution
-    q = np.bincount(labels).astype(float) / labels.size
-    q_hat = np.bincount(labels_hat).astype(float) / labels_hat.size
+    q = cluster_probability(clustering.labels,coarse_map=coarse_map)
+    q_hat = visit_probability(
+            propagation.visited_centroids,
+            propagation.t_visited,
+            coarse_map=coarse_map,
+            )
 
     # --> Start plot
     # ----------------------------------------------------------------------
@@ -357,7 +380,7 @@ def plot_cpd(x,x_hat):
             )
 
     # Ticks
-    ax.set_xticks(np.arange(0,10)+1)
+    ax.set_xticks(np.arange(0,K)+1)
     ax.set_yticks([])
     ax.tick_params(labelsize=TFONTSIZE)
 
@@ -402,6 +425,8 @@ def plot_autocorrelation(t,x,t_hat,x_hat,time_blocks,time_range,method='fft'):
     print('Plot autocorrelation function')
     print('-----------------------------\n')
 
+    plt = _pyplot()
+
     # Truncate at the same length
     size = min(t.size,t_hat.size)
     t = t[:size]
@@ -452,8 +477,8 @@ def plot_autocorrelation(t,x,t_hat,x_hat,time_blocks,time_range,method='fft'):
 def compute_autocorrelation(t,x,time_blocks: float,method):
     """Wrapper function to compute the autocorrelation.
 
-    Prepare the data in blocks of length `time_blocks` and calls the appropriate
-    function to compute the autocorrelation.
+    Splits the data in blocks of length `time_blocks` and calls
+    `cnm.analysis.autocorrelation`, which transforms all the blocks at once.
     The autocorrelation is block-averaged.
 
     Parameters
@@ -465,108 +490,23 @@ def compute_autocorrelation(t,x,time_blocks: float,method):
         Data matrix.
     time_blocks: float
         Time range of the blocks used to compute the autocorrelation block-wise.
+    method: str
+        'fft' normalizes the lag sums by the block length, 'dot' by the
+        number of overlapping samples.
 
     Returns
     -------
     R: ndarray
         Block averaged-autocorrelation of `x`.
     """
+    from cnm.analysis import autocorrelation
 
-    # Split into blocks of time time_blocks
+    # Number of blocks of time time_blocks
     n_blocks = int(t[-1]/float(time_blocks))
     if n_blocks == 0:
         n_blocks = 1
-    x_split = np.array_split(x,n_blocks)
-    t_split = np.array_split(t,n_blocks)
-
-    # Truncate the blocks so that they all have the same length
-    max_size = min([elt.shape[0] for elt in x_split])
-    x_split = [elt[:max_size] for elt in x_split]
-    t_split = [elt[:max_size] for elt in t_split]
-
-    # Loop over the blocks
-    for i_block,x_block in enumerate(x_split):
-
-
-        # Remove the mean
-        for i_dim in range(x.shape[1]):
-            x_block[:,i_dim] -= np.mean(x_block[:,i_dim])
-
-        # fft-based autocorrelation
-        if method == 'fft':
-            r = autocorrelation_fft(x_block)
-        elif method == 'dot':
-            r = autocorrelation_dot(x_block)
-
-        if i_block == 0:
-            R = r
-        else:
-            R += r
-
-    return R
-
-def autocorrelation_dot(x):
-    """Compute the autocorrelation function using the dot product.
-
-    This method is slow and not suited for large datasets.
-
-    Parameters
-    ----------
-    x: ndarray
-        Data matrix.
-
-    Returns
-    -------
-    R: ndarray
-        Autocorrelation of `x`.
-    """
-    n = x.shape[0]
-
-    # Compute the autocorrelation
-    corr_matrix = np.dot(x,x.T)
-    r = []
-    for i in range(n):
-        r.append(
-                np.sum(np.diag(corr_matrix,k=i)) / (n-i)
-                )
-    return np.array(r)
-
 
-def autocorrelation_fft(x):
-    """Compute the autocorrelation function of x with FFT, IFFT, and 0-padding
-
-    Parameters
-    ----------
-    x: ndarray
-        Data matrix.
-
-    Returns
-    -------
-    R: ndarray
-        Autocorrelation of `x`.
-    """
-
-    n = x.shape[0]
-
-    # pad 0s to 2n-1
-    ext_size=2*n-1
-    # nearest power of 2
-    fsize=2**np.ceil(np.log2(ext_size)).astype('int')
-
-    # Loop over the dimensions
-    for i_dim in range(x.shape[1]):
-
-        # do fft and ifft
-        cf=np.fft.fft(x[:,i_dim],fsize)
-        sf=cf.conjugate()*cf
-        corr=np.fft.ifft(sf).real
-        corr=corr/n
-
-        if i_dim == 0:
-            r = corr[:n]
-        else:
-            r += corr[:n]
-    return r
+    return autocorrelation(x,n_blocks,unbiased=(method == 'dot'))
 
 def create_lorenz_data():
     """Create the Lorenz data"""
@@ -606,6 +546,7 @@ def create_lorenz_data():
 def create_roessler_data():
     """Create the Lorenz data"""
 
+    from scipy.integrate import solve_ivp
 
     # Lorenz settings
     a = 0.1
@@ -638,3 +579,181 @@ def create_roessler_data():
 
     return data, t[1]-t[0]
 
+
+def _lorenz_rhs(q,sigma=10,rho=28,beta=8/3.):
+    """Right-hand side of the Lorenz system for an array of states."""
+    x, y, z = q[...,0], q[...,1], q[...,2]
+    return np.stack((
+        sigma * (y - x),
+        x * (rho - z) - y,
+        x * y - beta * z,
+        ),axis=-1)
+
+def _roessler_rhs(q,a=0.1,b=0.1,c=14):
+    """Right-hand side of the Roessler system for an array of states."""
+    x, y, z = q[...,0], q[...,1], q[...,2]
+    return np.stack((
+        -y - z,
+        x + a * y,
+        b + z * (x - c),
+        ),axis=-1)
+
+_systems = {
+        'lorenz': _lorenz_rhs,
+        'roessler': _roessler_rhs,
+        }
+
+def create_ensemble_data(system,ics,dt,n_steps,params=None,n_transient=0,
+                         n_substeps=1,n_jobs=None,cache_folder='output/synthetic'):
+    """Integrate many initial conditions of a synthetic system at once.
+
+    All the trajectories are advanced together with a fixed-step RK4 on
+    arrays of shape (n_ics,n_dim). With `n_jobs`, the initial conditions are
+    split among a process pool. The result is cached on disk, keyed by all
+    the parameters.
+
+    Parameters
+    ----------
+    system : str
+        'lorenz' or 'roessler'.
+    ics : ndarray of shape (n_ics,n_dim)
+        Initial conditions.
+    dt : float
+        Time step of the output.
+    n_steps : int
+        Number of output snapshots of each trajectory.
+    params : dict, optional
+        Parameters of the system, e.g., {'rho': 28} for Lorenz. Defaults to
+        the values of `create_lorenz_data` and `create_roessler_data`.
+    n_transient : int, optional
+        Number of time steps integrated and discarded before the output.
+    n_substeps : int, optional
+        Number of RK4 steps per time step.
+    n_jobs : int, optional
+        Number of processes. -1 uses all the cores.
+    cache_folder : str, optional
+        Folder of the cached trajectories. None disables the cache.
+
+    Returns
+    -------
+    data : ndarray of shape (n_ics,n_steps,n_dim)
+        The trajectories.
+    """
+
+    import hashlib
+
+    ics = np.atleast_2d(np.asarray(ics,dtype=float))
+    params = {} if params is None else dict(params)
+
+    # Cached trajectories
+    if cache_folder is not None:
+        key = hashlib.sha1(repr((
+            system,sorted(params.items()),float(dt),int(n_steps),
+            int(n_transient),int(n_substeps),ics.shape,
+            )).encode() + ics.tobytes()).hexdigest()[:16]
+        cache_path = os.path.join(cache_folder,'{}-{}.npy'.format(system,key))
+        if os.path.exists(cache_path):
+            print('Read from {}'.format(cache_path))
+            return np.load(cache_path)
+
+    arguments = (system,params,dt,n_steps,n_transient,n_substeps)
+    if n_jobs is not None and n_jobs < 0:
+        n_jobs = os.cpu_count()
+    if n_jobs is None or n_jobs == 1:
+        data = _integrate_rk4(ics,*arguments)
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        groups = np.array_split(ics,min(n_jobs,ics.shape[0]))
+        with ProcessPoolExecutor(len(groups)) as pool:
+            data = np.concatenate(list(pool.map(
+                _integrate_rk4,groups,*[[elt]*len(groups) for elt in arguments]
+                )))
+
+    if cache_folder is not None:
+        print('Save in {}'.format(cache_path))
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+        np.save(cache_path,data)
+
+    return data
+
+def _integrate_rk4(ics,system,params,dt,n_steps,n_transient,n_substeps):
+    """Fixed-step RK4 integration of all the initial conditions at once."""
+
+    def rhs(q):
+        return _systems[system](q,**params)
+
+    h = dt / n_substeps
+    q = ics.copy()
+    data = np.empty((ics.shape[0],n_steps,ics.shape[1]))
+    for i_step in range(n_transient + n_steps):
+        if i_step >= n_transient:
+            data[:,i_step-n_transient] = q
+        for _ in range(n_substeps):
+            k1 = rhs(q)
+            k2 = rhs(q + h/2 * k1)
+            k3 = rhs(q + h/2 * k2)
+            k4 = rhs(q + h * k3)
+            q = q + h/6 * (k1 + 2*k2 + 2*k3 + k4)
+
+    return data
+
+if __name__=='__main__':
+
+    import contextlib
+    import io
+    import shutil
+    import tempfile
+    from scipy.integrate import solve_ivp
+
+    dt, n_steps, n_substeps = 0.01, 300, 4
+    ics = np.array([[1.,1.,1.],[-5.,3.,20.],[8.,-2.,30.],[0.5,0.5,10.]])
+
+    # RK4 against an adaptive integrator with a tight tolerance
+    for system in ['lorenz','roessler']:
+        data = create_ensemble_data(
+                system,ics,dt,n_steps,n_substeps=n_substeps,cache_folder=None
+                )
+        assert data.shape == (ics.shape[0],n_steps,3)
+        np.testing.assert_array_equal(data[:,0],ics)
+        t = np.arange(n_steps) * dt
+        reference = solve_ivp(
+                lambda t, q: _systems[system](q),[0,t[-1]],ics[0],t_eval=t,
+                method='DOP853',rtol=1e-12,atol=1e-12,
+                ).y.T
+        np.testing.assert_allclose(data[0],reference,rtol=0,atol=1e-5)
+
+    # the process pool gives the same trajectories
+    serial = create_ensemble_data('lorenz',ics,dt,n_steps,cache_folder=None)
+    parallel = create_ensemble_data('lorenz',ics,dt,n_steps,n_jobs=2,cache_folder=None)
+    np.testing.assert_array_equal(parallel,serial)
+
+    # the transient steps are dropped
+    transient = create_ensemble_data(
+            'lorenz',ics,dt,n_steps-100,n_transient=100,cache_folder=None
+            )
+    np.testing.assert_array_equal(transient,serial[:,100:])
+
+    # cached trajectories, read at the second call
+    cache_folder = tempfile.mkdtemp()
+    try:
+        computed = create_ensemble_data(
+                'roessler',ics,dt,n_steps,params={'c': 10},cache_folder=cache_folder
+                )
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            cached = create_ensemble_data(
+                    'roessler',ics,dt,n_steps,params={'c': 10},cache_folder=cache_folder
+                    )
+        assert 'Read from {}'.format(cache_folder) in output.getvalue()
+        np.testing.assert_array_equal(cached,computed)
+        assert len(os.listdir(cache_folder)) == 1
+
+        # other parameters are not read from the cache
+        other = create_ensemble_data(
+                'roessler',ics,dt,n_steps,cache_folder=cache_folder
+                )
+        assert not np.array_equal(other,computed)
+        assert len(os.listdir(cache_folder)) == 2
+    finally:
+        shutil.rmtree(cache_folder)
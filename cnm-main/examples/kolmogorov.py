@@ -58,6 +58,7 @@ def run_kolmogorov():
             'dt': dt,
             'K': K,
             'L': L,
+            'cache': True,
             }
 
     transition_properties = TransitionProperties(**transition_config)
@@ -91,7 +92,7 @@ def run_kolmogorov():
     plot_time_series(t,data,t_hat,x_hat,time_range,plot_label,n_dim=n_dim)
 
     # cluster probability distribution
-    plot_cpd(data,x_hat)
+    plot_cpd(clustering,propagation)
 
     # autocorrelation function
     time_blocks = t_hat[-1]
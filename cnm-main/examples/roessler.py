@@ -57,6 +57,7 @@ def run_roessler():
             'dt': dt,
             'K': K,
             'L': L,
+            'cache': True,
             }
 
     transition_properties = TransitionProperties(**transition_config)
@@ -88,7 +89,7 @@ def run_roessler():
     plot_time_series(t,data,t_hat,x_hat,time_range,plot_label)
 
     # cluster probability distribution
-    plot_cpd(data,x_hat)
+    plot_cpd(clustering,propagation)
 
     # autocorrelation function
     time_blocks = 100